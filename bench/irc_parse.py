@@ -0,0 +1,78 @@
+"""Measures how fast IRC lines can be parsed, with the default fast parser,
+the strict regex parser, and the bytes parser that defers decoding.
+
+Run it from the repository root:
+
+    python bench/irc_parse.py [lines-per-run]
+"""
+import sys
+import time
+
+from dywypi.dialect.irc.message import IRCMessage
+
+
+# Roughly the mix of traffic seen in a busy channel: mostly chatter, some
+# joins and parts, the occasional ping and numeric
+SAMPLE_TRAFFIC = [
+    ':eevee!eevee@b.d.f.l PRIVMSG #bot :does anyone know how to make asyncio do the thing',
+    ':someone!~someone@host-1-2-3-4.example.net PRIVMSG #bot :yes',
+    ':someone!~someone@host-1-2-3-4.example.net PRIVMSG #bot :no wait, the other thing',
+    ':another!another@user/another PRIVMSG #bot :dywypi: echo hello',
+    ':joiner!~joiner@gateway/web/irccloud.com/x-abcdefg JOIN #bot',
+    ':parter!~parter@unaffiliated/parter PART #bot :Leaving',
+    ':quitter!~quitter@127.0.0.1 QUIT :Ping timeout: 240 seconds',
+    ':eevee!eevee@b.d.f.l MODE #bot +o someone',
+    'PING :irc.veekun.com',
+    ':irc.veekun.com 353 dywypi = #bot :@eevee +dywypi someone another joiner',
+    ':irc.veekun.com 366 dywypi #bot :End of /NAMES list.',
+    ':irc.veekun.com NOTICE dywypi :*** You are connected using TLS',
+]
+
+
+def measure(lines, **kwargs):
+    parse = IRCMessage.parse
+    start = time.perf_counter()
+    for line in lines:
+        parse(line, **kwargs)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def measure_decode(lines):
+    # What the client used to do: decode everything, then parse
+    parse = IRCMessage.parse
+    start = time.perf_counter()
+    for line in lines:
+        parse(line.decode('utf8'))
+    return len(lines) / (time.perf_counter() - start)
+
+
+def measure_bytes(lines):
+    parse_bytes = IRCMessage.parse_bytes
+    start = time.perf_counter()
+    for line in lines:
+        parse_bytes(line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200000
+    lines = (SAMPLE_TRAFFIC * (count // len(SAMPLE_TRAFFIC) + 1))[:count]
+
+    # Best of a few runs, to smooth over noise
+    fast = max(measure(lines) for _ in range(3))
+    strict = max(measure(lines, strict=True) for _ in range(3))
+
+    print("fast parser:   {:12,.0f} lines/s".format(fast))
+    print("strict parser: {:12,.0f} lines/s".format(strict))
+    print("speedup:       {:12.2f}x".format(fast / strict))
+
+    raw_lines = [line.encode('utf8') for line in lines]
+    decoded = max(measure_decode(raw_lines) for _ in range(3))
+    lazy = max(measure_bytes(raw_lines) for _ in range(3))
+
+    print("decode, parse: {:12,.0f} lines/s".format(decoded))
+    print("parse_bytes:   {:12,.0f} lines/s".format(lazy))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
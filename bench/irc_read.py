@@ -0,0 +1,84 @@
+"""Measures how quickly a burst of IRC lines can be pulled off a stream and
+handled: one readline() per line, versus the client's own reader, which reads
+large chunks and splits every complete line out at once.
+
+Run it from the repository root:
+
+    python bench/irc_read.py [lines-per-burst]
+"""
+import asyncio
+import sys
+import time
+
+from dywypi.dialect.irc.client import IRCClient
+from dywypi.state import Network
+
+
+# Channel chatter no plugin wants, so the client drops each line right after
+# parsing it, and the numbers are mostly about reading
+BURST_LINE = (
+    b':chatter!~chatter@gateway/web/irccloud.com/x-abcdefg '
+    b'PRIVMSG #bot :just some idle chatter\r\n'
+)
+
+
+class NoSubscriptions:
+    wants_commands = False
+
+    def wants(self, event_cls):
+        return False
+
+
+def make_client(loop, reader):
+    client = IRCClient(loop, Network('bench'))
+    client.event_subscriptions = NoSubscriptions()
+    client._reader = reader
+    return client
+
+
+@asyncio.coroutine
+def read_by_line(client):
+    reader = client._reader
+    while not reader.at_eof():
+        line = yield from reader.readline()
+        if not line:
+            break
+        client._handle_line(line[:-2])
+
+
+@asyncio.coroutine
+def read_by_chunk(client):
+    # Same loop as IRCClient._start_read_loop, minus the error handling
+    while not client._reader.at_eof():
+        yield from client._read_messages()
+
+
+def measure(loop, read, burst, count):
+    reader = asyncio.StreamReader(loop=loop)
+    reader.feed_data(burst)
+    reader.feed_eof()
+    client = make_client(loop, reader)
+
+    start = time.perf_counter()
+    loop.run_until_complete(read(client))
+    return count / (time.perf_counter() - start)
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 10000
+    burst = BURST_LINE * count
+    loop = asyncio.get_event_loop()
+
+    by_line = max(
+        measure(loop, read_by_line, burst, count) for _ in range(5))
+    by_chunk = max(
+        measure(loop, read_by_chunk, burst, count) for _ in range(5))
+
+    print("burst of {:,} lines".format(count))
+    print("readline():    {:12,.0f} lines/s".format(by_line))
+    print("_read_messages:{:12,.0f} lines/s".format(by_chunk))
+    print("speedup:       {:12.2f}x".format(by_chunk / by_line))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,97 @@
+"""Measures how quickly a client can reconnect to a local TLS server: with a
+fresh default SSL context and full handshake every time, versus a network's
+shared context that resumes the previous session.
+
+Needs the openssl command-line tool, to make a throwaway certificate.  Run it
+from the repository root:
+
+    python bench/tls_reconnect.py [connections]
+"""
+import asyncio
+import os.path
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+from dywypi.state import Network
+
+
+def make_certificate(directory):
+    cert_file = os.path.join(directory, 'cert.pem')
+    key_file = os.path.join(directory, 'key.pem')
+    subprocess.check_call(
+        [
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-keyout', key_file, '-out', cert_file, '-days', '1',
+            '-subj', '/CN=localhost',
+            '-addext', 'subjectAltName=DNS:localhost',
+        ],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_file, key_file
+
+
+@asyncio.coroutine
+def handle_client(reader, writer):
+    # Something like a server greeting, so the client has data to wait for
+    # and any session ticket arrives along with it
+    writer.write(b':localhost NOTICE * :*** Hello\r\n')
+    yield from reader.read()
+    writer.close()
+
+
+@asyncio.coroutine
+def reconnect_loop(server, count, make_context, save):
+    reused = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        reader, writer = yield from asyncio.open_connection(
+            'localhost', server.port, ssl=make_context())
+        yield from reader.readline()
+        if writer.get_extra_info('ssl_object').session_reused:
+            reused += 1
+        save(writer)
+        writer.close()
+    return count / (time.perf_counter() - start), reused
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200
+    loop = asyncio.get_event_loop()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert_file, key_file = make_certificate(directory)
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(cert_file, key_file)
+        tcp_server = loop.run_until_complete(asyncio.start_server(
+            handle_client, 'localhost', 0, ssl=server_context))
+        tcp_server.port = tcp_server.sockets[0].getsockname()[1]
+
+        fresh_rate, fresh_reused = loop.run_until_complete(reconnect_loop(
+            tcp_server, count,
+            lambda: ssl.create_default_context(cafile=cert_file),
+            lambda writer: None))
+
+        network = Network('bench')
+        network.configure_tls(ca_file=cert_file)
+        network.add_server('localhost', tcp_server.port, tls=True)
+        irc_server = network.servers[0]
+        shared_rate, shared_reused = loop.run_until_complete(reconnect_loop(
+            tcp_server, count,
+            lambda: network.ssl_context,
+            irc_server.save_tls_session))
+
+        tcp_server.close()
+        loop.run_until_complete(tcp_server.wait_closed())
+
+    print("{:,} reconnects".format(count))
+    print("fresh context:   {:8,.0f} connections/s, {:4} resumed".format(
+        fresh_rate, fresh_reused))
+    print("shared context:  {:8,.0f} connections/s, {:4} resumed".format(
+        shared_rate, shared_reused))
+    print("speedup:         {:8.2f}x".format(shared_rate / fresh_rate))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
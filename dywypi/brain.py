@@ -71,7 +71,10 @@ class Brain:
         # TODO less hard-coded here would be nice
         clients = []
         for network in self.networks.values():
-            clients.append(network.client_class(loop, network))
+            client = network.client_class(loop, network)
+            # Let the client skip building events no plugin cares about
+            client.event_subscriptions = self.plugin_manager
+            clients.append(client)
 
         # TODO hmm this feels slightly janky; should this all be done earlier
         # perhaps
@@ -1,19 +1,37 @@
 import asyncio
-from asyncio.queues import Queue
 from collections import deque
 from concurrent.futures import CancelledError
 from datetime import datetime
 from datetime import timedelta
 import getpass
+import itertools
 import logging
+import random
+import re
 
-from dywypi.event import PublicMessage, PrivateMessage
+from dywypi.event import Connected, Disconnected
+from dywypi.event import Message, PublicMessage, PrivateMessage
+from dywypi.event import ModeChange
 from dywypi.formatting import Bold, Color, Style
+from dywypi.queue import EventQueue
 from dywypi.state import Peer
+from .flood import FloodControl
+from .flood import OVERFLOW_COLLAPSE
+from .flood import PRIORITY_CHATTER
+from .flood import PRIORITY_COMMAND
+from .flood import PRIORITY_PROTOCOL
+from .lag import LagMonitor
 from .message import IRCMessage
+from .message import NUMERICS
+from .state import CASEMAPPINGS
 from .state import IRCChannel
+from .state import IRCDict
 from .state import IRCMode
 from .state import IRCTopic
+from .state import IRCUserRegistry
+from .state import parse_mode_changes
+from .state import split_prefix
+from .state import UNKNOWN
 
 log = logging.getLogger(__name__)
 
@@ -38,12 +56,178 @@ FOREGROUND_CODES = {
 }
 
 
+# mIRC formatting codes: a color, with optional foreground and background, or
+# one of the single-byte toggles (or \x0f, which resets everything)
+_FORMAT_CODE_PATTERN = re.compile(
+    r'\x03(?:(\d{1,2})(?:,(\d{1,2}))?)?|[\x02\x0f\x11\x16\x1d\x1e\x1f]')
+# A line is split into atoms that mustn't be broken apart: formatting codes and
+# single characters
+_SPLIT_ATOM_PATTERN = re.compile(
+    _FORMAT_CODE_PATTERN.pattern + '|.', re.DOTALL)
+
+
+class _FormatState:
+    """Which mIRC formatting is in effect at some point in a line, so it can be
+    re-applied at the start of the next one.
+    """
+    def __init__(self):
+        self.toggles = set()
+        self.color = None
+
+    def update(self, text):
+        for match in _FORMAT_CODE_PATTERN.finditer(text):
+            code = match.group()
+            if code == '\x0f':
+                self.toggles.clear()
+                self.color = None
+            elif code[0] == '\x03':
+                fg, bg = match.groups()
+                if fg is None:
+                    self.color = None
+                else:
+                    # Always use two digits, or a restored color followed by
+                    # a digit would read as a different color
+                    self.color = '\x03{:02d}'.format(int(fg))
+                    if bg is not None:
+                        self.color += ',{:02d}'.format(int(bg))
+            else:
+                self.toggles ^= {code}
+
+    def render(self):
+        return ''.join(sorted(self.toggles)) + (self.color or '')
+
+
+def split_text(text, max_bytes, charset='utf8'):
+    """Split `text` into a list of lines of no more than `max_bytes` each, once
+    encoded.  Lines are split between words where possible, and never in the
+    middle of a character or formatting code; formatting still in effect at
+    the end of a line is repeated at the start of the next.
+    """
+    def size(s):
+        return len(s.encode(charset, 'replace'))
+
+    lines = []
+    state = _FormatState()
+    line = ''
+    line_bytes = 0
+    # Formatting carried over from the previous line; the line has nothing
+    # of its own in it until it's longer than this
+    line_start = ''
+    spaces = ''
+
+    for chunk in re.split('( +)', text):
+        if not chunk:
+            continue
+        if chunk[0] == ' ':
+            spaces = chunk
+            continue
+
+        # Spaces between words go on whichever line the next word does, and
+        # are dropped if that's a new line
+        if line_bytes + size(spaces + chunk) > max_bytes and line != line_start:
+            lines.append(line)
+            line = line_start = state.render()
+            line_bytes = size(line)
+            spaces = ''
+
+        chunk = spaces + chunk
+        spaces = ''
+        chunk_bytes = size(chunk)
+        if line_bytes + chunk_bytes <= max_bytes:
+            line += chunk
+            line_bytes += chunk_bytes
+            state.update(chunk)
+            continue
+
+        # One word too long for a line of its own; break it wherever
+        for match in _SPLIT_ATOM_PATTERN.finditer(chunk):
+            atom = match.group()
+            atom_bytes = size(atom)
+            if line_bytes + atom_bytes > max_bytes and line != line_start:
+                lines.append(line)
+                line = line_start = state.render()
+                line_bytes = size(line)
+            line += atom
+            line_bytes += atom_bytes
+            state.update(atom)
+
+    if spaces and line_bytes + size(spaces) <= max_bytes:
+        line += spaces
+    if line != line_start or not lines:
+        lines.append(line)
+    return lines
+
+
+def _normalize_command(command):
+    """Numerics with a known name always arrive as that name, so that's what
+    handlers are keyed by.
+    """
+    return NUMERICS.get(command, command)
+
+
+# Default send priorities for particular commands; anything else is
+# PRIORITY_COMMAND.  See `dywypi.dialect.irc.flood`.
+COMMAND_PRIORITIES = {
+    'AUTHENTICATE': PRIORITY_PROTOCOL,
+    'CAP': PRIORITY_PROTOCOL,
+    'NICK': PRIORITY_PROTOCOL,
+    'PASS': PRIORITY_PROTOCOL,
+    'PING': PRIORITY_PROTOCOL,
+    'PONG': PRIORITY_PROTOCOL,
+    'QUIT': PRIORITY_PROTOCOL,
+    'USER': PRIORITY_PROTOCOL,
+
+    'NOTICE': PRIORITY_CHATTER,
+    'PRIVMSG': PRIORITY_CHATTER,
+    'TAGMSG': PRIORITY_CHATTER,
+}
+
+
+# Connection states; see `IRCClient.state`
+STATE_DISCONNECTED = 'disconnected'
+STATE_CONNECTING = 'connecting'
+STATE_CONNECTED = 'connected'
+
+
+# Replies to a JOIN, up until the end of the names list
+JOIN_REPLIES = [
+    'JOIN',
+    'RPL_TOPIC',
+    'RPL_TOPICWHOTIME',
+    'RPL_NOTOPIC',
+    'RPL_NAMREPLY',
+]
+
+
+# Errors that mention a target, but are actually responses to messages we never
+# wait for replies to, like PRIVMSG
+UNSOLICITED_ERRORS = {'ERR_CANNOTSENDTOCHAN'}
+
+
 class IRCError(Exception):
     @property
     def message(self):
         return self.args[0]
 
 
+class _MessageWaiter:
+    """A single request waiting on replies; see `IRCClient.gather_messages`.
+    """
+    def __init__(self, loop, start, finish, target):
+        self.future = asyncio.Future(loop=loop)
+        # Command => whether it finishes the reply
+        self.commands = dict.fromkeys(start, False)
+        self.commands.update(dict.fromkeys(finish, True))
+        self.target = target
+        self.collected = []
+        self.removed = False
+
+        # For labeled requests: the labeled-response batch, and any batches
+        # nested inside it
+        self.batch_ref = None
+        self.batch_refs = []
+
+
 class IRCClient:
     """Higher-level IRC client.  Takes care of most of the hard parts of IRC:
     incoming server messages are bundled into more intelligible events (see
@@ -58,38 +242,172 @@ class IRCClient:
         # likely, channel-specific and decoded separately and...
         self.charset = 'utf8'
 
-        self.joined_channels = {}  # name => Channel
-
-        # IRC server features, as reported by ISUPPORT, with defaults taken
-        # from the RFC.
-        self.len_nick = 9
-        self.len_channel = 200
-        self.len_message = 510
-        # These lengths don't have limits mentioned in the RFC, so going with
-        # the smallest known values in the wild
-        self.len_kick = 80
-        self.len_topic = 80
-        self.len_away = 160
-        self.max_watches = 0
-        self.max_targets = 1
-        self.channel_types = set('#&')
-        self.channel_modes = {}  # TODO, haha.
-        self.channel_prefixes = {}  # TODO here too.  IRCMode is awkward.
-        self.network_title = self.network.name
-        self.features = {}
+        # Everything about the server that ISUPPORT can change, including how
+        # it compares names; see `_reset_features`
+        self._reset_features()
+
+        self.joined_channels = IRCDict(self._fold_name)  # name => Channel
+        # One Peer per user we share a channel with
+        self.users = IRCUserRegistry(self._fold_name)
+
+        # Whether we're connected to anything, and which server.  Registration
+        # counts as part of connecting.
+        self.state = STATE_DISCONNECTED
+        self.current_server = None
+        # Servers are tried in turn, both for the first connection and after
+        # losing one.  The wait between failed attempts doubles each time,
+        # from reconnect_delay up to reconnect_max_delay, give or take some
+        # randomness so a netsplit doesn't send every client back at once.
+        self.reconnect = True
+        self.reconnect_delay = 1
+        self.reconnect_max_delay = 300
+        self.connect_timeout = 30
+        # How many servers to try at once, and how long to give each one a
+        # head start over the next; see `_race_servers`
+        self.connect_race = 1
+        self.connect_race_stagger = 0.25
+        self._server_index = 0
+        self._connect_attempts = 0
+        self._disconnecting = False
+        # Channels we were in when the connection dropped, to rejoin
+        self._rejoin_channels = []
+
+
+        # IRCv3 capabilities we'll ask for if the server has them, the ones
+        # the server has (mapped to their values, if any), and the ones it's
+        # actually agreed to
+        self.wanted_capabilities = {
+            'account-notify',
+            'away-notify',
+            'batch',
+            'echo-message',
+            'extended-join',
+            'labeled-response',
+            'message-tags',
+            'multi-prefix',
+            'server-time',
+            'userhost-in-names',
+        }
+        self.available_capabilities = {}
+        self.capabilities = set()
+        # True from CAP LS until CAP END, i.e., while registration is on hold
+        self._cap_negotiating = False
+        # Number of CAP REQs that haven't been ACKed or NAKed yet
+        self._cap_requests = 0
 
         # Various intermediate state used for waiting for replies and
         # aggregating multi-part replies
         # TODO hmmm so what happens if state just gets left here forever?  do
         # we care?
-        self._pending_names = {}
-        self._names_futures = {}
-        self._pending_topics = {}
-        self._join_futures = {}
-
-        self._message_waiters = deque()
-
-        self.read_queue = Queue(loop=loop)
+        self._pending_names = IRCDict(self._fold_name)
+        self._pending_topics = IRCDict(self._fold_name)
+        self._join_futures = IRCDict(self._fold_name)
+        # Keys we're joining channels with, until the JOIN comes back
+        self._join_keys = IRCDict(self._fold_name)
+        # Task joining everything in the network's autojoin list, once
+        # registered; see `join_many`
+        self.autojoin_future = None
+
+        # Requests waiting on replies.  _message_waiters maps a reply command
+        # to a dict of target => waiters, in the order they were made;
+        # _target_waiters maps a target to its waiters, for matching errors.
+        self._message_waiters = {}
+        self._target_waiters = {}
+        self.reply_timeout = 60
+
+        # Requests sent with an IRCv3 label; maps the label, and the refs of
+        # any batches belonging to that label, to the waiter
+        self._label_waiters = {}
+        self._label_batches = {}
+        self._next_label = itertools.count()
+
+        # Per-client copy of the class's protocol handlers, so extra handlers
+        # can be added to one client without affecting the others
+        self._handlers = dict(self._get_handler_table())
+
+        # Events waiting for the plugins; only messages are ever dropped.
+        # Set read_queue.maxsize and .overflow to change how it fills up.
+        self.read_queue = EventQueue(
+            loop, droppable=lambda event: isinstance(event, Message))
+        # Something with `wants(event_cls)` and `wants_commands`, normally the
+        # `PluginManager`, saying which events are worth building; None means
+        # build everything
+        self.event_subscriptions = None
+
+        # Outgoing flood control: how many lines can go out at once, and how
+        # many per second after that.  The send queue itself is created on
+        # connect.
+        self.flood_burst = 5
+        self.flood_rate = 0.5
+        # Lines waiting to go to a single channel or nick: how many may
+        # pile up, what to do past that, and how many lines particular
+        # targets may send per turn (default 1).  See FloodControl.
+        self.flood_target_depth = 50
+        self.flood_overflow = OVERFLOW_COLLAPSE
+        self.flood_weights = {}
+        self.send_queue = None
+
+        # How much to ask for from the socket at a time, and anything left
+        # over from the last read that isn't a complete line yet
+        self.read_chunk_size = 65536
+        self._read_buffer = b''
+        # Longest line we'll wait for the end of: up to 8191 bytes of tags
+        # (IRCv3's limit), plus a few times the usual 512 for servers that
+        # stretch it.  Anything longer is thrown away rather than buffered
+        # forever.
+        self.max_line_length = 8191 + 4 * 512
+        self._discarding_line = False
+
+        # Outgoing bytes the socket hasn't taken yet: `drain` waits once
+        # there are more than write_buffer_high, until there are no more than
+        # write_buffer_low.  If the buffer is still over write_buffer_low
+        # write_stall_timeout seconds after going over write_buffer_high, the
+        # server has stopped reading, and the connection is dropped.
+        self.write_buffer_high = 65536
+        self.write_buffer_low = 16384
+        self.write_stall_timeout = 30
+        self._stall_timer = None
+
+        # PING the server every ping_interval seconds, and give up on the
+        # connection if it doesn't answer within ping_timeout.  The monitor
+        # itself is created once registered, fresh for each connection.
+        self.ping_interval = 60
+        self.ping_timeout = 120
+        self.lag_monitor = None
+
+    @classmethod
+    def _get_handler_table(cls):
+        """Returns a dict mapping commands to the unbound ``_handle_*`` methods
+        that handle them.  Built once per class, the first time it's needed,
+        so subclasses get their own table with their own methods in it.
+
+        Boy do I ever hate this pattern but it's slightly more maintainable
+        than a 500-line if tree.
+        """
+        table = cls.__dict__.get('_handler_table')
+        if table is None:
+            table = {}
+            for name in dir(cls):
+                if name.startswith('_handle_'):
+                    command = _normalize_command(name[len('_handle_'):])
+                    table[command] = getattr(cls, name)
+            cls._handler_table = table
+        return table
+
+    def add_handler(self, command, handler):
+        """Register an extra protocol handler on this client.  `command` may be
+        either a symbolic name like ``RPL_WHOISUSER`` or a raw numeric like
+        ``311``.  `handler` is called as ``handler(client, message)`` for every
+        matching message, and may return an event to be put on the read queue.
+
+        Only one handler exists per command, so this replaces any existing
+        one.  The old handler (or None) is returned, so a replacement can
+        delegate to it.
+        """
+        command = _normalize_command(command)
+        old_handler = self._handlers.get(command)
+        self._handlers[command] = handler
+        return old_handler
 
     def get_channel(self, channel_name):
         """Returns a `Channel` object containing everything the client
@@ -107,22 +425,195 @@ class IRCClient:
 
     @asyncio.coroutine
     def connect(self):
-        """Coroutine for connecting to a single server.
+        """Coroutine for connecting to the network.  Each of the network's
+        servers is tried in turn until one accepts, waiting longer after each
+        failure; if `reconnect` is off, only one server is tried, and any
+        error is raised.  With `connect_race` above 1, that many servers are
+        tried at a time, and the first to answer wins.
+
+        Once connected, a dropped connection is re-established the same way,
+        and the channels the client was in are rejoined.  `Disconnected` and
+        `Connected` events are produced along the way.
 
         Note that this will nonblock until the client is "registered", defined
         as the first PING/PONG exchange.
         """
-        # TODO this is a poor excuse for round-robin  :)
-        server = self.current_server = self.network.servers[0]
+        self._disconnecting = False
+        while True:
+            if self._connect_attempts:
+                yield from asyncio.sleep(
+                    self._reconnect_wait(), loop=self.loop)
+            self._connect_attempts += 1
+
+            servers = self.network.servers
+            count = max(1, min(self.connect_race, len(servers)))
+            candidates = [
+                servers[(self._server_index + n) % len(servers)]
+                for n in range(count)
+            ]
+            self._server_index += count
+
+            self.state = STATE_CONNECTING
+            try:
+                server, reader, writer = yield from self._race_servers(
+                    candidates)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.state = STATE_DISCONNECTED
+                if not self.reconnect:
+                    raise
+                log.warning(
+                    "Couldn't connect to %s: %r",
+                    ", ".join(
+                        "{}:{}".format(server.host, server.port)
+                        for server in candidates),
+                    e)
+            else:
+                self._start_session(server, reader, writer)
+                return
+
+    @asyncio.coroutine
+    def _race_servers(self, servers):
+        """Coroutine that connects to each of `servers`, starting each attempt
+        `connect_race_stagger` seconds after the last, or as soon as the last
+        one fails.  Returns ``(server, reader, writer)`` for the first to
+        succeed, and cancels or closes the rest.  If none succeed, raises the
+        last error.
+        """
+        servers = list(servers)
+        attempts = {}  # task => server
+        pending = set()
+        winner = None
+        error = None
+        try:
+            while winner is None and (servers or pending):
+                timeout = None
+                if servers:
+                    server = servers.pop(0)
+                    task = asyncio.async(asyncio.wait_for(
+                        server.connect(self.loop), self.connect_timeout,
+                        loop=self.loop), loop=self.loop)
+                    attempts[task] = server
+                    pending.add(task)
+                    if servers:
+                        timeout = self.connect_race_stagger
+
+                done, pending = yield from asyncio.wait(
+                    pending, timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED, loop=self.loop)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    error = task.exception()
+        finally:
+            # Losers that connected anyway get hung up on
+            for task in attempts:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    reader, writer = task.result()
+                    writer.close()
+
+        if winner is None:
+            raise error
+        reader, writer = winner.result()
+        return (attempts[winner], reader, writer)
+
+    def _reconnect_wait(self):
+        """How long to wait before the next connection attempt."""
+        delay = min(
+            self.reconnect_max_delay,
+            self.reconnect_delay * 2 ** (self._connect_attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def _reset_features(self):
+        """Forget what the last server said in ISUPPORT.  Servers on the same
+        network don't always agree, so this happens on every connect.
+        """
+        # How the server compares names; RFC 1459's until ISUPPORT says
+        # otherwise.  Everything keyed by a name must go through this.
+        self.casemapping = CASEMAPPINGS['rfc1459']
+
+        # IRC server features, as reported by ISUPPORT, with defaults taken
+        # from the RFC.
+        self.len_nick = 9
+        self.len_channel = 200
+        self.len_message = 510
+        # These lengths don't have limits mentioned in the RFC, so going with
+        # the smallest known values in the wild
+        self.len_kick = 80
+        self.len_topic = 80
+        self.len_away = 160
+        self.max_watches = 0
+        self.max_targets = 1
+        # Per-command target limits from TARGMAX; None means no limit
+        self.command_max_targets = {}
+        self.channel_types = set('#&')
+        # Channel prefixes => how many of those channels we may be in; None
+        # means no limit
+        self.channel_limits = {}
+        # Channel mode letter => IRCMode, and prefix symbol => IRCMode for the
+        # modes users can have; RFC 1459's until ISUPPORT says otherwise
+        self.channel_modes = {}
+        self.channel_prefixes = {}
+        # Just the prefix modes, highest rank first
+        self.prefix_modes = []
+        self._set_prefix_modes('(ov)@+')
+        self._set_channel_modes('b,k,l,imnpst')
+        self.network_title = self.network.name
+        self.features = {}
+
+    def _fold_flood_weights(self):
+        return {
+            self._fold_name(target): weight
+            for target, weight in self.flood_weights.items()
+        }
+
+    def _start_session(self, server, reader, writer):
+        """Set up a fresh connection and start registering."""
+        self.current_server = server
+        self._reset_features()
 
         # TODO i'm pretty sure the server tells us what our nick is, and we
         # should believe that instead
         self.nick = self.network.preferred_nick
-
-        # TODO: handle disconnection, somehow.  probably affects a lot of
-        # things.
-        self._reader, self._writer = yield from server.connect(self.loop)
-
+        # Our ident@host, as other people see it; not known until the server
+        # tells us
+        self.userhost = None
+
+        self._reader, self._writer = reader, writer
+        self.lag_monitor = LagMonitor(
+            self.loop,
+            lambda token: self.send_message('PING', token),
+            self._lag_timed_out,
+            interval=self.ping_interval,
+            timeout=self.ping_timeout,
+        )
+        self._writer.transport.set_write_buffer_limits(
+            high=self.write_buffer_high, low=self.write_buffer_low)
+        self._read_buffer = b''
+        self._discarding_line = False
+        self.send_queue = FloodControl(
+            self.loop, self._write,
+            burst=self.flood_burst,
+            rate=self.flood_rate,
+            max_target_depth=self.flood_target_depth,
+            overflow=self.flood_overflow,
+            weights=self._fold_flood_weights(),
+            collapse=self._render_omitted,
+        )
+        self.available_capabilities = {}
+        self.capabilities = set()
+        self._cap_requests = 0
+
+        # Ask what IRCv3 capabilities the server has.  Servers that have never
+        # heard of CAP just ignore it and carry on registering; servers that
+        # have will hold off until we send CAP END.
+        self._cap_negotiating = bool(self.wanted_capabilities)
+        if self._cap_negotiating:
+            self.send_message('CAP', 'LS', '302')
         if server.password:
             self.send_message('PASS', server.password)
         self.send_message('NICK', self.nick)
@@ -131,13 +622,61 @@ class IRCClient:
         # Start the reader loop, or we can't respond to anything
         self._read_loop_task = asyncio.Task(self._start_read_loop())
         asyncio.async(self._read_loop_task, loop=self.loop)
+        self._read_loop_task.add_done_callback(self._read_loop_done)
+
+    def _read_loop_done(self, task):
+        if self._disconnecting:
+            # We hung up on purpose
+            return
+
+        server = self.current_server
+        log.warning("Lost connection to %s:%s", server.host, server.port)
+        self.state = STATE_DISCONNECTED
+        self.send_queue.close()
+        self._cancel_stall_timer()
+        self.lag_monitor.stop()
+        self._writer.close()
+
+        # Everything about the old connection is gone, except which channels
+        # to go back to
+        self._rejoin_channels = [
+            name if channel.key in (None, UNKNOWN) else (name, channel.key)
+            for name, channel in self.joined_channels.items()
+        ]
+        self.joined_channels.clear()
+        self.users.clear()
+        self._pending_names.clear()
+        self._pending_topics.clear()
+        self._fail_waiters(ConnectionResetError("Lost connection to server"))
+
+        self.read_queue.put_nowait(Disconnected(
+            server, reconnecting=self.reconnect, client=self))
+        if self.reconnect:
+            asyncio.async(self.connect(), loop=self.loop)
+
+    def _fail_waiters(self, exc):
+        """Fail every request still waiting on a reply."""
+        waiters = set(self._label_waiters.values())
+        for waiters_by_target in self._message_waiters.values():
+            for target_waiters in waiters_by_target.values():
+                waiters.update(target_waiters)
+        for waiter in waiters:
+            if not waiter.future.done():
+                waiter.future.set_exception(exc)
 
     @asyncio.coroutine
     def disconnect(self):
+        self._disconnecting = True
+        self.state = STATE_DISCONNECTED
+
         # Quit
         self.send_message('QUIT', 'Seeya!')
 
-        # Flush the write buffer
+        # Flush the write buffer; anything still held back by flood control
+        # is moot now
+        self.send_queue.close()
+        self._cancel_stall_timer()
+        self.lag_monitor.stop()
         yield from self._writer.drain()
         self._writer.close()
 
@@ -150,7 +689,7 @@ class IRCClient:
 
         # Read until the connection closes
         while not self._reader.at_eof():
-            yield from self._reader.readline()
+            yield from self._reader.read(self.read_chunk_size)
 
     @asyncio.coroutine
     def _start_read_loop(self):
@@ -163,104 +702,413 @@ class IRCClient:
         # queue
         while not self._reader.at_eof():
             try:
-                yield from self._read_message()
+                yield from self._read_messages()
             except CancelledError:
                 return
+            except OSError:
+                # The connection died without a clean EOF -- reset, timed
+                # out, TLS failure, whatever.  The reader keeps raising the
+                # same error forever, so stop here and let the reconnect
+                # logic take over.
+                return
             except Exception:
                 log.exception("Smothering exception in IRC read loop")
 
     @asyncio.coroutine
-    def gather_messages(self, *start, finish):
-        fut = asyncio.Future()
-        messages = {}
-        for command in start:
-            messages[command] = False
-        for command in finish:
-            messages[command] = True
-        collected = []
-        self._message_waiters.append((fut, messages, collected))
-        yield from fut
-        return collected
+    def gather_messages(self, *start, finish, target=None, timeout=None):
+        """Coroutine that collects replies to something we just sent.
+
+        `start` lists commands that may appear partway through the reply, and
+        `finish` lists commands that end it.  If `target` is given, only
+        replies mentioning that nick or channel among their first few args are
+        collected, which lets any number of requests for different targets be
+        in flight at once.  Requests for the same target are answered in the
+        order they were made.
+
+        Returns the list of collected messages, including the one that
+        finished the reply.  Raises `IRCError` if the reply was an error, or
+        `asyncio.TimeoutError` if nothing finished it within `timeout`
+        seconds (default `reply_timeout`).
+        """
+        waiter = self._add_waiter(start, finish, target)
+        return (yield from self._wait_for_waiter(waiter, timeout))
+
+    def _add_waiter(self, start, finish, target):
+        """Start collecting replies for `gather_messages`.  Separate so that
+        several requests can be lined up before any of them are sent.
+        """
+        waiter = _MessageWaiter(self.loop, start, finish, target)
+        key = None if target is None else self._fold_name(target)
+        for command in waiter.commands:
+            (self._message_waiters
+                .setdefault(command, {})
+                .setdefault(key, deque())
+                .append(waiter))
+        if key is not None:
+            self._target_waiters.setdefault(key, deque()).append(waiter)
+        return waiter
+
+    @asyncio.coroutine
+    def _wait_for_waiter(self, waiter, timeout):
+        if timeout is None:
+            timeout = self.reply_timeout
+
+        try:
+            return (yield from asyncio.wait_for(
+                waiter.future, timeout, loop=self.loop))
+        finally:
+            self._remove_waiter(waiter)
+
+    def _fold_name(self, name):
+        """Normalize a nick or channel name, for use as a dict key."""
+        return self.casemapping.fold(name)
+
+    def _is_me(self, nick):
+        return self._fold_name(nick) == self._fold_name(self.nick)
+
+    def _remove_waiter(self, waiter):
+        if waiter.removed:
+            return
+        waiter.removed = True
+
+        key = None if waiter.target is None else self._fold_name(waiter.target)
+        for command in waiter.commands:
+            by_target = self._message_waiters[command]
+            by_target[key].remove(waiter)
+            if not by_target[key]:
+                del by_target[key]
+                if not by_target:
+                    del self._message_waiters[command]
+
+        if key is not None:
+            self._target_waiters[key].remove(waiter)
+            if not self._target_waiters[key]:
+                del self._target_waiters[key]
+
+    @asyncio.coroutine
+    def send_request(self, command, *args, replies=(), finish, target=None,
+            timeout=None):
+        """Coroutine that sends a command and collects the server's replies
+        to it.  Returns the list of replies, or raises `IRCError` if any of
+        them was an error.
+
+        If the server supports IRCv3 ``labeled-response``, the command is
+        sent with a label, and the replies are exactly the lines the server
+        says belong to it; any number of these can be in flight at once.
+        Otherwise, this falls back to `gather_messages`, which uses
+        `replies`, `finish`, and `target` to guess.
+        """
+        if 'labeled-response' not in self.capabilities:
+            self.send_message(command, *args)
+            return (yield from self.gather_messages(
+                *replies, finish=finish, target=target, timeout=timeout))
+
+        if timeout is None:
+            timeout = self.reply_timeout
+
+        label = str(next(self._next_label))
+        waiter = self._label_waiters[label] = _MessageWaiter(
+            self.loop, (), (), target)
+        self.send_message(command, *args, tags={'label': label})
+
+        try:
+            return (yield from asyncio.wait_for(
+                waiter.future, timeout, loop=self.loop))
+        finally:
+            del self._label_waiters[label]
+            for ref in waiter.batch_refs:
+                self._label_batches.pop(ref, None)
+
+    def _possibly_gather_labeled(self, message):
+        """Feed a message to a labeled request, if it belongs to one.  Returns
+        True if it did.
+        """
+        tags = message.tags
+        if message.command == 'BATCH':
+            ref = message.args[0]
+            if ref.startswith('-'):
+                waiter = self._label_batches.get(ref[1:])
+                if waiter is None:
+                    return False
+                if ref[1:] == waiter.batch_ref:
+                    self._finish_labeled(waiter)
+                return True
+
+            if 'label' in tags:
+                # Start of a labeled-response batch
+                waiter = self._label_waiters.get(tags['label'])
+                if waiter is None:
+                    return False
+                waiter.batch_ref = ref[1:]
+            elif 'batch' in tags:
+                # Start of some other batch, nested inside one of ours
+                waiter = self._label_batches.get(tags['batch'])
+                if waiter is None:
+                    return False
+            else:
+                return False
+
+            waiter.batch_refs.append(ref[1:])
+            self._label_batches[ref[1:]] = waiter
+            return True
+
+        if 'batch' in tags:
+            waiter = self._label_batches.get(tags['batch'])
+            if waiter is None:
+                return False
+            waiter.collected.append(message)
+            return True
+
+        if 'label' in tags:
+            # A single labeled reply, or an ACK meaning there is no reply
+            waiter = self._label_waiters.get(tags['label'])
+            if waiter is None:
+                return False
+            if message.command != 'ACK':
+                waiter.collected.append(message)
+            self._finish_labeled(waiter)
+            return True
+
+        return False
+
+    def _finish_labeled(self, waiter):
+        if waiter.future.done():
+            # Already timed out or cancelled
+            return
+
+        for message in waiter.collected:
+            if message.is_error:
+                waiter.future.set_exception(IRCError(message))
+                return
+        waiter.future.set_result(waiter.collected)
 
     def _possibly_gather_message(self, message):
-        if not self._message_waiters:
+        # Replies to labeled requests are easy to spot.  The end of a batch
+        # doesn't have any tags, so BATCH has to be checked regardless.
+        if self._label_waiters and (message.tags or message.command == 'BATCH'):
+            if self._possibly_gather_labeled(message):
+                return
+
+        # Most lines aren't a reply to anything, and this check doesn't need
+        # to look at the message's args at all
+        by_target = self._message_waiters.get(message.command)
+        if by_target is not None:
+            # The target of a reply is nearly always one of the first few
+            # args, so look each one up; fall back to a request that didn't
+            # care about the target.  A numeric's first arg is always our own
+            # nick, which would otherwise match a request about ourselves.
+            waiters = None
+            args = message.args[1:4] if message.numeric else message.args[:3]
+            for arg in args:
+                waiters = by_target.get(self._fold_name(arg))
+                if waiters:
+                    break
+            else:
+                waiters = by_target.get(None)
+
+            if waiters:
+                self._feed_waiter(waiters[0], message)
             return
 
-        # TODO there is a general ongoing problem here with matching up
-        # responses.  ESPECIALLY when error codes are possible.  something here
-        # is gonna have to get a bit fancier.
-
-        fut, waiting_on, collected = self._message_waiters[0]
-        # TODO is it possible for even a PING to appear in the middle of
-        # some other response?
-        # TODO this is still susceptible to weirdness when there's, say, a
-        # queued error response to a PRIVMSG on its way back; it'll look
-        # like the call we just made failed, and all the real responses
-        # will be dropped.  can we assume some set of error replies ONLY
-        # happen in response to sending a message of some kind, maybe?
+        # An error we weren't explicitly expecting.  Fail whatever was asking
+        # about the error's target, if anything -- but some errors look like
+        # they're about a target when they're really about a PRIVMSG or
+        # similar, which we never wait on.
         # TODO for that matter, where does the error response to a PRIVMSG
         # even go?  the whole problem is that we can't know for sure when
         # it succeeded, unless we put a timeout on every call to say()
-        finish = False
-        if message.command in waiting_on:
-            finish = waiting_on[message.command]
-        elif message.is_error:
-            # Always consider an error as finishing
-            # TODO but we might have gotten this error in response to something
-            # else we did before this message...  :S
-            if message.command in {'ERR_CANNOTSENDTOCHAN'}:
-                # Looks like a PRIVMSG error or similar, so probably not a
-                # response to this particular message.
-                return
-            finish = True
-        elif not collected:
-            # Got a regular response we weren't expecting, AND this future
-            # hasn't started collecting yet -- the response probably just
-            # hasn't started coming back yet, so don't do anything yet.
+        if (self._target_waiters and message.is_error and
+                message.command not in UNSOLICITED_ERRORS):
+            args = message.args
+            if len(args) > 1:
+                waiters = self._target_waiters.get(self._fold_name(args[1]))
+                if waiters:
+                    self._feed_waiter(waiters[0], message)
+
+    def _feed_waiter(self, waiter, message):
+        waiter.collected.append(message)
+        if message.is_error or waiter.commands.get(message.command):
+            # Done, one way or another.  Stop matching this waiter right away,
+            # so the next line can go to whoever's next in line.
+            self._remove_waiter(waiter)
+            if waiter.future.done():
+                # Already timed out or cancelled
+                pass
+            elif message.is_error:
+                waiter.future.set_exception(IRCError(message))
+            else:
+                waiter.future.set_result(waiter.collected)
+
+    @asyncio.coroutine
+    def _read_messages(self):
+        """Internal dispatcher for messages received from the server.
+
+        Reads whatever's available, up to `read_chunk_size`, and handles every
+        complete line in it at once; any partial line is kept around for next
+        time.  During a netsplit or a big join, this means one trip through
+        the event loop per few hundred lines, rather than per line.
+        """
+        data = yield from self._reader.read(self.read_chunk_size)
+        if not data:
+            # EOF
             return
 
-        # If we get here, we expected this response, and should keep
-        # feeding into this future.
-        collected.append(message)
+        # The RFC says lines end with CRLF, but be generous and accept a bare
+        # LF as well, as plenty of servers (and humans with netcat) do
+        lines = (self._read_buffer + data).split(b'\n')
+        self._read_buffer = lines.pop()
+        if self._discarding_line and lines:
+            # The rest of an overlong line, finally ending
+            del lines[0]
+            self._discarding_line = False
+        if len(self._read_buffer) > self.max_line_length:
+            if not self._discarding_line:
+                log.warning(
+                    "Discarding line over %d bytes from server",
+                    self.max_line_length)
+            self._read_buffer = b''
+            self._discarding_line = True
+
+        for line in lines:
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            if not line:
+                continue
+
+            # One bad line shouldn't take the rest of the batch down with it
+            try:
+                event = self._handle_line(line)
+            except Exception:
+                log.exception("Smothering exception handling %r", line)
+                continue
 
-        if finish:
-            # Done, one way or another
-            self._message_waiters.popleft()
-            if message.is_error:
-                fut.set_exception(IRCError(message))
-            else:
-                fut.set_result(collected)
+            if event is not None:
+                yield from self.read_queue.put(event)
 
-    @asyncio.coroutine
-    def _read_message(self):
-        """Internal dispatcher for messages received from the server."""
-        line = yield from self._reader.readline()
-        assert line.endswith(b'\r\n')
-        line = line[:-2]
-
-        # TODO valerr, unicodeerr
-        message = IRCMessage.parse(line.decode(self.charset))
+    def _handle_line(self, line):
+        """Handle a single line from the server, minus the line ending.
+        Returns the event it produced, if any.
+        """
+        # TODO valerr
+        message = IRCMessage.parse_bytes(line, self.charset)
         log.debug("recv: %r", message)
 
         # TODO unclear whether this should go before or after _handle_foo
         self._possibly_gather_message(message)
 
-        # Boy do I ever hate this pattern but it's slightly more maintainable
-        # than a 500-line if tree.
-        handler = getattr(self, '_handle_' + message.command, None)
-        event = None
+        handler = self._handlers.get(message.command)
         if handler:
-            event = handler(message)
-        self.read_queue.put_nowait((message, event))
+            return handler(self, message)
+        return None
+
+    def _handle_CAP(self, message):
+        # CAP <nick or *> <subcommand> [*] :<capabilities>
+        # The lone * means the list continues on another line.
+        me, subcommand, *args = message.args
+        more_coming = len(args) > 1 and args[0] == '*'
+        caps = args[-1].split() if args else []
+
+        if subcommand in ('LS', 'NEW'):
+            # NEW comes from cap-notify, which is implied by CAP LS 302
+            new_caps = set()
+            for cap in caps:
+                name, _, value = cap.partition('=')
+                self.available_capabilities[name] = value
+                new_caps.add(name)
+            if subcommand == 'LS':
+                if more_coming:
+                    return
+                new_caps = set(self.available_capabilities)
+            self._request_capabilities(
+                (self.wanted_capabilities & new_caps) - self.capabilities)
+        elif subcommand == 'DEL':
+            for name in caps:
+                self.available_capabilities.pop(name, None)
+                self.capabilities.discard(name)
+        elif subcommand == 'ACK':
+            for cap in caps:
+                if cap.startswith('-'):
+                    self.capabilities.discard(cap[1:])
+                else:
+                    # = and ~ are modifiers from the original CAP draft
+                    self.capabilities.add(cap.lstrip('=~'))
+            self._cap_requests -= 1
+        elif subcommand == 'NAK':
+            # REQ is all-or-nothing, so nothing from this line was enabled
+            self._cap_requests -= 1
+
+        self._possibly_end_cap()
+
+    def _request_capabilities(self, names):
+        """Send as many CAP REQs as it takes to ask for all of `names`."""
+        # Room left on the line after "CAP REQ :"
+        budget = self.len_message - 9
+        line = []
+        length = 0
+        for name in sorted(names):
+            if line and length + 1 + len(name) > budget:
+                self.send_message('CAP', 'REQ', ' '.join(line))
+                self._cap_requests += 1
+                line = []
+                length = 0
+            line.append(name)
+            length += len(name) + 1
+        if line:
+            self.send_message('CAP', 'REQ', ' '.join(line))
+            self._cap_requests += 1
+
+    def _possibly_end_cap(self):
+        """End capability negotiation, once there's nothing left to wait for,
+        so registration can continue.
+        """
+        if self._cap_negotiating and not self._cap_requests:
+            self.send_message('CAP', 'END')
+            self._cap_negotiating = False
+
+    def _handle_ERR_UNKNOWNCOMMAND(self, message):
+        # A server that doesn't do CAP at all, but does complain about it
+        me, command, *rest = message.args
+        if command == 'CAP' and self._cap_negotiating:
+            self._cap_negotiating = False
+            self._cap_requests = 0
 
     def _handle_PING(self, message):
         # PONG
         self.send_message('PONG', message.args[-1])
 
+    def _handle_PONG(self, message):
+        # Hopefully an answer to one of our own PINGs
+        self.lag_monitor.pong(message.args[-1])
+
     def _handle_RPL_WELCOME(self, message):
-        # Initial registration: do autojoins, and any other onconnect work
-        for channel_name in self.network.autojoins:
-            asyncio.async(self.join(channel_name), loop=self.loop)
+        # Most servers end the welcome with our full nick!ident@host
+        welcome = message.args[-1].split()
+        if welcome and '!' in welcome[-1] and '@' in welcome[-1]:
+            self.userhost = welcome[-1].split('!', 1)[1]
+
+        self.state = STATE_CONNECTED
+        self._connect_attempts = 0
+        # By now any TLS session ticket has certainly arrived
+        self.current_server.save_tls_session(self._writer)
+        self.lag_monitor.start()
+
+        # Initial registration: do autojoins, and rejoin whatever we were in
+        # before a reconnect
+        # Rejoins go first, since they know the keys for their channels
+        channels = self._rejoin_channels + self.network.autojoins
+        self._rejoin_channels = []
+        if channels:
+            self.autojoin_future = asyncio.async(
+                self._autojoin(channels), loop=self.loop)
+
+        return Connected(self.current_server, client=self, raw=message)
+
+    def _handle_RPL_HOSTHIDDEN(self, message):
+        # Our host has been cloaked or otherwise changed
+        me, host, *_ = message.args
+        if self.userhost:
+            ident = self.userhost.split('@', 1)[0]
+            self.userhost = '{}@{}'.format(ident, host)
 
     def _handle_RPL_ISUPPORT(self, message):
         me, *features, human_text = message.args
@@ -286,52 +1134,211 @@ class IRCClient:
             elif feature == 'CHANTYPES':
                 self.channel_types = set(value)
             elif feature == 'PREFIX':
-                # List of channel user modes, in relative priority order, in
-                # the format (ov)@+
-                assert value[0] == '('
-                letters, symbols = value[1:].split(')')
-                assert len(letters) == len(symbols)
-                self.channel_prefixes.clear()
-                for letter, symbol in zip(letters, symbols):
-                    mode = IRCMode(letter, prefix=symbol)
-                    self.channel_modes[letter] = mode
-                    self.channel_prefixes[symbol] = mode
+                self._set_prefix_modes(value)
             elif feature == 'MAXTARGETS':
-                self.max_targets = int(value)
+                # No value means no limit
+                self.max_targets = int(value) if value else None
+            elif feature == 'TARGMAX':
+                # Comma-separated list of COMMAND:limit, where again no limit
+                # means no limit
+                self.command_max_targets.clear()
+                for pair in value.split(','):
+                    command, _, limit = pair.partition(':')
+                    self.command_max_targets[command.upper()] = (
+                        int(limit) if limit else None)
+            elif feature == 'CHANLIMIT':
+                # Comma-separated list of prefixes:limit, e.g. #&:50
+                self.channel_limits.clear()
+                for pair in value.split(','):
+                    prefixes, _, limit = pair.partition(':')
+                    self.channel_limits[prefixes] = (
+                        int(limit) if limit else None)
             elif feature == 'CHANMODES':
-                # Four groups delimited by lists: list-style (+b), arg required
-                # (+k), arg required only to set (+l), argless
-                lists, args, argsets, argless = value.split(',')
-                for letter in lists:
-                    self.channel_modes[letter] = IRCMode(
-                        letter, multi=True)
-                for letter in args:
-                    self.channel_modes[letter] = IRCMode(
-                        letter, arg_on_set=True, arg_on_remove=True)
-                for letter in argsets:
-                    self.channel_modes[letter] = IRCMode(
-                        letter, arg_on_set=True)
-                for letter in argless:
-                    self.channel_modes[letter] = IRCMode(letter)
+                self._set_channel_modes(value)
+            elif feature == 'CASEMAPPING':
+                try:
+                    self.casemapping = CASEMAPPINGS[value]
+                except KeyError:
+                    log.warning(
+                        "Unknown CASEMAPPING %r; assuming ascii", value)
+                    self.casemapping = CASEMAPPINGS['ascii']
+                # Flood control was set up before we knew
+                self.send_queue.set_weights(self._fold_flood_weights())
             elif feature == 'NETWORK':
                 self.network_title = value
 
+    def _set_prefix_modes(self, value):
+        # List of channel user modes, in relative priority order, in the
+        # format (ov)@+
+        assert value[0] == '('
+        letters, symbols = value[1:].split(')')
+        assert len(letters) == len(symbols)
+        for mode in self.prefix_modes:
+            self.channel_modes.pop(mode.letter, None)
+        self.channel_prefixes.clear()
+        self.prefix_modes = []
+        for rank, (letter, symbol) in enumerate(zip(letters, symbols)):
+            # These always take a nick, whether being set or removed
+            mode = IRCMode(letter, prefix=symbol, bit=1 << rank,
+                arg_on_set=True, arg_on_remove=True)
+            self.channel_modes[letter] = mode
+            self.channel_prefixes[symbol] = mode
+            self.prefix_modes.append(mode)
+
+    def _set_channel_modes(self, value):
+        # Four groups delimited by lists: list-style (+b), arg required
+        # (+k), arg required only to set (+l), argless
+        lists, args, argsets, argless, *_ = value.split(',')
+        for letter, mode in list(self.channel_modes.items()):
+            if mode.prefix is None:
+                self.channel_modes.pop(letter, None)
+        for letter in lists:
+            self.channel_modes[letter] = IRCMode(
+                letter, multi=True)
+        for letter in args:
+            self.channel_modes[letter] = IRCMode(
+                letter, arg_on_set=True, arg_on_remove=True)
+        for letter in argsets:
+            self.channel_modes[letter] = IRCMode(
+                letter, arg_on_set=True)
+        for letter in argless:
+            self.channel_modes[letter] = IRCMode(letter)
+
     def _handle_JOIN(self, message):
-        channel_name, = message.args
-        joiner = Peer.from_prefix(message.prefix)
+        # With extended-join, this also has the joiner's account (or *) and
+        # realname
+        channel_name, *extended = message.args
+        nick, ident, host = split_prefix(message.prefix)
         # TODO should there be a self.me?  how...
-        if joiner.name == self.nick:
+        if self._is_me(nick):
             # We just joined a channel
+            self.userhost = '{}@{}'.format(ident, host)
             #assert channel_name not in self.joined_channels
-            # TODO key?  do we care?
             # TODO what about channel configuration and anon non-joined
             # channels?  how do these all relate...
-            channel = IRCChannel(self, channel_name)
+            # The key is worth keeping, to get back in after a reconnect
+            channel = IRCChannel(
+                self, channel_name,
+                key=self._join_keys.pop(channel_name, None))
             self.joined_channels[channel.name] = channel
         else:
             # Someone else just joined the channel
+            joiner = self.users.add(channel_name, nick, ident, host)
+            if extended and extended[0] != '*':
+                joiner.account = extended[0]
             self.joined_channels[channel_name].add_user(joiner)
 
+    def _handle_PART(self, message):
+        channel_name, *reason = message.args
+        self._remove_from_channel(channel_name, split_prefix(message.prefix)[0])
+
+    def _handle_KICK(self, message):
+        channel_name, nick, *reason = message.args
+        self._remove_from_channel(channel_name, nick)
+
+    def _remove_from_channel(self, channel_name, nick):
+        channel = self.joined_channels.get(channel_name)
+        if channel is None:
+            return
+
+        if self._is_me(nick):
+            # We left, so everyone else in there is now out of sight
+            del self.joined_channels[channel_name]
+            for name in channel.users:
+                self.users.remove(channel_name, name)
+        else:
+            channel.remove_user(nick)
+            self.users.remove(channel_name, nick)
+
+    def _handle_QUIT(self, message):
+        nick = split_prefix(message.prefix)[0]
+        for channel_name in self.users.forget(nick):
+            channel = self.joined_channels.get(channel_name)
+            if channel is not None:
+                channel.remove_user(nick)
+
+    def _handle_NICK(self, message):
+        old_nick = split_prefix(message.prefix)[0]
+        new_nick, = message.args
+        if self._is_me(old_nick):
+            self.nick = new_nick
+
+        if self.users.rename(old_nick, new_nick) is None:
+            return
+        for channel_name in self.users.channels_of(new_nick):
+            channel = self.joined_channels.get(channel_name)
+            if channel is not None:
+                channel.rename_user(old_nick, new_nick)
+
+    def _handle_TOPIC(self, message):
+        channel_name, text = message.args
+        channel = self.joined_channels.get(channel_name)
+        if channel is not None:
+            channel.topic = IRCTopic(
+                text, self.users.from_prefix(message.prefix),
+                datetime.utcnow())
+
+    def _handle_MODE(self, message):
+        target, modestring, *args = message.args
+        channel = self.joined_channels.get(target)
+        if channel is None:
+            # Our own user modes, or a channel we're not in
+            return
+
+        changes = parse_mode_changes(self.channel_modes, modestring, args)
+        channel.apply_mode_changes(changes)
+
+        subscriptions = self.event_subscriptions
+        if subscriptions is None or subscriptions.wants(ModeChange):
+            return ModeChange(
+                self.users.from_prefix(message.prefix), channel, changes,
+                client=self, raw=message)
+
+    def _handle_RPL_CHANNELMODEIS(self, message):
+        # Reply to MODE #channel: all the non-list modes it has
+        me, channel_name, modestring, *args = message.args
+        channel = self.joined_channels.get(channel_name)
+        if channel is not None:
+            channel.apply_mode_changes(
+                parse_mode_changes(self.channel_modes, modestring, args))
+
+    def _handle_RPL_BANLIST(self, message):
+        self._add_list_entry('b', message)
+
+    def _handle_RPL_EXCEPTLIST(self, message):
+        self._add_list_entry('e', message)
+
+    def _handle_RPL_INVITELIST(self, message):
+        self._add_list_entry('I', message)
+
+    def _add_list_entry(self, letter, message):
+        # Replies to MODE #channel b and friends, one per entry, possibly
+        # followed by who set it and when
+        me, channel_name, mask, *setter = message.args
+        channel = self.joined_channels.get(channel_name)
+        if channel is not None:
+            channel.lists.setdefault(letter, set()).add(mask)
+
+    def _handle_ACCOUNT(self, message):
+        # account-notify: someone logged in or out.  * means out.
+        account, = message.args
+        if account == '*':
+            account = None
+        peer = self.users.get(split_prefix(message.prefix)[0])
+        if peer is not None:
+            peer.account = account
+
+    def _handle_AWAY(self, message):
+        # away-notify: someone went away, with a message, or came back,
+        # without one
+        if message.args:
+            away = message.args[0]
+        else:
+            away = None
+        peer = self.users.get(split_prefix(message.prefix)[0])
+        if peer is not None:
+            peer.away = away
+
     def _handle_RPL_TOPIC(self, message):
         # Topic.  Sent when joining or when requesting the topic.
         # TODO this doesn't handle the "requesting" part
@@ -346,7 +1353,7 @@ class IRCClient:
         # TODO what if me != me?
         me, channel_name, author, timestamp = message.args
         topic = self._pending_topics.setdefault(channel_name, IRCTopic(''))
-        topic.author = Peer.from_prefix(author)
+        topic.author = self.users.from_prefix(author)
         topic.timestamp = datetime.utcfromtimestamp(int(timestamp))
 
     def _handle_RPL_NAMREPLY(self, message):
@@ -371,54 +1378,67 @@ class IRCClient:
         me, channel_name, info = message.args
         namelist = self._pending_names.pop(channel_name, [])
 
-        if channel_name in self._names_futures:
-            # TODO we should probably not ever have a names future AND a
-            # pending join at the same time.  or, does it matter?
-            self._names_futures[channel_name].set_result(namelist)
-            del self._names_futures[channel_name]
-
         if channel_name in self.joined_channels:
-            # Join synchronized!
             channel = self.joined_channels[channel_name]
-            channel.sync = True
+            # A join with no RPL_TOPIC means there's no topic, but a later
+            # NAMES request says nothing about it either way
+            topic = self._pending_topics.pop(channel_name, None)
+            if topic is not None or not channel.sync:
+                channel.topic = topic
 
-            channel.topic = self._pending_topics.pop(channel_name, None)
+            # Join synchronized!
+            channel.sync = True
 
             for name in namelist:
-                modes = set()
-                # TODO use features!
-                while name and name[0] in '+%@&~':
-                    modes.add(name[0])
+                modes = 0
+                while name and name[0] in self.channel_prefixes:
+                    modes |= self.channel_prefixes[name[0]].bit
                     name = name[1:]
 
-                # TODO haha no this is so bad.
-                # TODO the bot should, obviously, keep a record of all
-                # known users as well.  alas, mutable everything.
-                peer = Peer(name, None, None)
-
+                # userhost-in-names gives us the full prefix
+                peer = self.users.add(channel_name, *split_prefix(name))
                 channel.add_user(peer, modes)
 
-            if channel_name in self._join_futures:
-                # Update the Future
-                self._join_futures[channel_name].set_result(channel)
-                del self._join_futures[channel_name]
-
     def _handle_PRIVMSG(self, message):
         # PRIVMSG target :text
-        target_name, text = message.args
+        # The text is the expensive part to decode, so leave it alone until
+        # it's definitely needed
+        target_name = message.arg(0)
+        is_public = target_name[:1] in self.channel_types
+        cls = PublicMessage if is_public else PrivateMessage
+
+        # Most chatter in a busy channel is of no interest to anyone, unless
+        # it's a command for us, so check before building anything
+        subscriptions = self.event_subscriptions
+        if subscriptions is not None and not subscriptions.wants(cls):
+            if not subscriptions.wants_commands:
+                return
+            if is_public and not self._is_addressed_to_us(message.arg(1)):
+                return
 
-        source = Peer.from_prefix(message.prefix)
+        target_name, text = message.args
+        source = self.users.from_prefix(message.prefix)
+        if self._is_me(source.name) and 'echo-message' in self.capabilities:
+            # Our own message, echoed back; plugins don't need to hear
+            # themselves talk
+            return
 
-        if target_name[0] in self.channel_types:
+        if is_public:
             target = self.get_channel(target_name)
-            cls = PublicMessage
         else:
             # TODO this is /us/, so, surely ought to be known
             target = Peer(target_name, None, None)
-            cls = PrivateMessage
 
         return cls(source, target, text, client=self, raw=message)
 
+    def _is_addressed_to_us(self, text):
+        """Whether a public message starts with our nick, like "dywypi: hi".
+        Same test `PluginManager.fire` uses to spot commands.
+        """
+        nick = self.nick
+        return text.startswith(nick) and text[len(nick):len(nick) + 1] in (
+            ':', ',', ' ')
+
     @asyncio.coroutine
     def read_event(self):
         """Produce a single IRC event.
@@ -426,8 +1446,7 @@ class IRCClient:
         This client does not do any kind of multiplexing or event handler
         notification; that's left to a higher level.
         """
-        message, event = yield from self.read_queue.get()
-        return event
+        return (yield from self.read_queue.get())
 
 
     # Implementations of particular commands
@@ -437,25 +1456,28 @@ class IRCClient:
     @asyncio.coroutine
     def whois(self, target):
         """Coroutine that queries for information about a target."""
-        self.send_message('WHOIS', target)
-        messages = yield from self.gather_messages(
-            'RPL_WHOISUSER',
-            'RPL_WHOISSERVER',
-            'RPL_WHOISOPERATOR',
-            'RPL_WHOISIDLE',
-            'RPL_WHOISCHANNELS',
-            'RPL_WHOISVIRT',
-            'RPL_WHOIS_HIDDEN',
-            'RPL_WHOISSPECIAL',
-            'RPL_WHOISSECURE',
-            'RPL_WHOISSTAFF',
-            'RPL_WHOISLANGUAGE',
+        messages = yield from self.send_request(
+            'WHOIS', target,
+            replies=[
+                'RPL_WHOISUSER',
+                'RPL_WHOISSERVER',
+                'RPL_WHOISOPERATOR',
+                'RPL_WHOISIDLE',
+                'RPL_WHOISCHANNELS',
+                'RPL_WHOISVIRT',
+                'RPL_WHOIS_HIDDEN',
+                'RPL_WHOISSPECIAL',
+                'RPL_WHOISSECURE',
+                'RPL_WHOISSTAFF',
+                'RPL_WHOISLANGUAGE',
+            ],
             finish=[
                 'RPL_ENDOFWHOIS',
                 'ERR_NOSUCHSERVER',
                 'ERR_NONICKNAMEGIVEN',
                 'ERR_NOSUCHNICK',
             ],
+            target=target,
         )
 
         # nb: The first two args for all the responses are our nick and the
@@ -486,48 +1508,254 @@ class IRCClient:
     @asyncio.coroutine
     def say(self, target, message):
         """Coroutine that sends a message to a target, which may be either a
-        `Channel` or a `Peer`.
+        `Channel` or a `Peer`.  Messages too long for one line are split across
+        as many as it takes.
+        """
+        yield from self.broadcast([target], message)
+
+    @asyncio.coroutine
+    def broadcast(self, targets, message, *, command='PRIVMSG'):
+        """Coroutine that sends the same message to several targets, using as
+        few lines as the server allows: targets are combined into one line,
+        up to the server's MAXTARGETS or TARGMAX and the line length limit.
+
+        Nonblocks while too much is waiting to be sent; see `drain`.
         """
-        self.send_message('PRIVMSG', target, message)
+        unique_targets = []
+        seen = set()
+        for target in targets:
+            folded = self._fold_name(target)
+            if folded not in seen:
+                seen.add(folded)
+                unique_targets.append(target)
+        if not unique_targets:
+            return
+
+        # Every recipient sees the message as though it were only sent to
+        # them, so the longest target name decides how much text fits
+        budget = min(
+            self._text_budget(command, target) for target in unique_targets)
+        lines = split_text(message, budget, self.charset)
+
+        # Then pack as many targets into each line as will fit next to the
+        # longest line of text
+        max_targets = self.command_max_targets.get(command, self.max_targets)
+        overhead = len('{} :'.format(command).encode(self.charset)) + max(
+            len(line.encode(self.charset)) for line in lines)
+        groups = []
+        group = []
+        group_bytes = overhead
+        for target in unique_targets:
+            target_bytes = len(target.encode(self.charset)) + 1
+            if group and (
+                    group_bytes + target_bytes > self.len_message or
+                    max_targets is not None and len(group) >= max_targets):
+                groups.append(group)
+                group = []
+                group_bytes = overhead
+            group.append(target)
+            group_bytes += target_bytes
+        groups.append(group)
+
+        for group in groups:
+            for line in lines:
+                self.send_message(command, ','.join(group), line)
+
+        # Don't let a chatty plugin outrun the server
+        yield from self.drain()
+
+    def _text_budget(self, command, target):
+        """How many bytes of text fit in a single message sent to `target`,
+        once the server has put our prefix on it and relayed it.
+        """
+        # Before we know our ident@host, assume the longest ident and host
+        # anyone is likely to have
+        userhost = self.userhost or '{}@{}'.format('x' * 10, 'x' * 63)
+        overhead = ':{}!{} {} {} :'.format(
+            self.nick, userhost, command, target)
+        return self.len_message - len(overhead.encode(self.charset))
 
     @asyncio.coroutine
     def join(self, channel_name, key=None):
         """Coroutine that joins a channel, and nonblocks until the join is
-        "synchronized" (defined as receiving the nick list).
+        "synchronized" (defined as receiving the nick list).  Returns the
+        channel.
         """
         if channel_name in self._join_futures:
             return self._join_futures[channel_name]
 
+        if key is not None:
+            self._join_keys[channel_name] = key
+        fut = self._join_futures[channel_name] = asyncio.async(
+            self._join(channel_name, key), loop=self.loop)
+        fut.add_done_callback(
+            lambda fut: self._join_finished(channel_name))
+        return fut
+
+    def _join_finished(self, channel_name):
+        self._join_futures.pop(channel_name, None)
+        self._join_keys.pop(channel_name, None)
+
+    @asyncio.coroutine
+    def _join(self, channel_name, key):
         # TODO multiple?  error on commas?
         if key is None:
-            self.send_message('JOIN', channel_name)
+            args = (channel_name,)
         else:
-            self.send_message('JOIN', channel_name, key)
+            args = (channel_name, key)
 
         # Clear out any lingering names list
         self._pending_names[channel_name] = []
 
-        # Return a Future, to be populated by the message loop
-        fut = self._join_futures[channel_name] = asyncio.Future()
-        return fut
+        # Errors here will fail the request anyway, since their first arg is
+        # the channel name
+        yield from self.send_request(
+            'JOIN', *args,
+            replies=JOIN_REPLIES,
+            finish=['RPL_ENDOFNAMES'],
+            target=channel_name,
+        )
+        # The handlers have already run by now, so the channel exists
+        return self.get_channel(channel_name)
+
+    @asyncio.coroutine
+    def join_many(self, channels, *, timeout=None):
+        """Coroutine that joins several channels at once, packing them into as
+        few JOIN lines as the server allows.  `channels` is an iterable of
+        channel names or (name, key) pairs.
+
+        Nonblocks until every channel has either synchronized or failed, then
+        returns a dict mapping each name to its channel, or to the exception
+        saying why it couldn't be joined.  Channels beyond the server's
+        CHANLIMIT fail without being tried.
+        """
+        wanted = IRCDict(self._fold_name)
+        for channel in channels:
+            if isinstance(channel, str):
+                name, key = channel, None
+            else:
+                name, key = channel
+            # A channel listed twice keeps whichever key it was given
+            if wanted.get(name) is None:
+                wanted[name] = key
+
+        results = {}
+        futures = {}
+        to_send = []
+        for name, key in wanted.items():
+            if name in self.joined_channels:
+                results[name] = self.joined_channels[name]
+                continue
+            if name in self._join_futures:
+                futures[name] = self._join_futures[name]
+                continue
+            if self._channel_limit_reached(name):
+                results[name] = IRCError(IRCMessage(
+                    'ERR_TOOMANYCHANNELS', self.nick, name,
+                    "You have joined too many channels"))
+                continue
+
+            # Start listening before anything is sent, so no reply can slip
+            # past; the server answers each channel separately, so each gets
+            # its own waiter
+            self._pending_names[name] = []
+            if key is not None:
+                self._join_keys[name] = key
+            waiter = self._add_waiter(JOIN_REPLIES, ['RPL_ENDOFNAMES'], name)
+            fut = self._join_futures[name] = asyncio.async(
+                self._wait_for_join(waiter, name, timeout), loop=self.loop)
+            fut.add_done_callback(
+                lambda fut, name=name: self._join_finished(name))
+            futures[name] = fut
+            to_send.append((name, key))
+
+        for args in self._pack_joins(to_send):
+            self.send_message('JOIN', *args)
+
+        if futures:
+            yield from asyncio.wait(futures.values(), loop=self.loop)
+        for name, fut in futures.items():
+            results[name] = fut.exception() or fut.result()
+
+        return {name: results[name] for name in wanted}
+
+    @asyncio.coroutine
+    def _wait_for_join(self, waiter, channel_name, timeout):
+        yield from self._wait_for_waiter(waiter, timeout)
+        return self.get_channel(channel_name)
+
+    def _channel_limit_reached(self, channel_name):
+        """Whether joining another channel like this one would go over the
+        server's CHANLIMIT, counting channels we're still joining.
+        """
+        for prefixes, limit in self.channel_limits.items():
+            if channel_name[:1] not in prefixes:
+                continue
+            if limit is None:
+                return False
+
+            used = set(self.joined_channels) | set(self._join_futures)
+            return sum(1 for name in used if name[:1] in prefixes) >= limit
+        return False
+
+    def _pack_joins(self, channels):
+        """Yield the args for as few JOIN lines as will fit the given (name,
+        key) pairs.
+        """
+        # Keys match up with channels in order, so channels with keys have to
+        # come first on a line
+        channels = sorted(channels, key=lambda pair: pair[1] is None)
+        max_targets = self.command_max_targets.get('JOIN')
+        base_size = len('JOIN')
+
+        names = []
+        keys = []
+        size = base_size
+        for name, key in channels:
+            extra = len(name.encode(self.charset)) + 1
+            if key is not None:
+                extra += len(key.encode(self.charset)) + 1
+            if names and (
+                    size + extra > self.len_message or
+                    max_targets is not None and len(names) >= max_targets):
+                yield (','.join(names),) + ((','.join(keys),) if keys else ())
+                names = []
+                keys = []
+                size = base_size
+
+            names.append(name)
+            if key is not None:
+                keys.append(key)
+            size += extra
+
+        if names:
+            yield (','.join(names),) + ((','.join(keys),) if keys else ())
+
+    @asyncio.coroutine
+    def _autojoin(self, channels):
+        results = yield from self.join_many(channels)
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                log.warning("Couldn't autojoin %s: %r", name, result)
+        return results
 
     @asyncio.coroutine
     def names(self, channel_name):
         """Coroutine that returns a list of names in a channel."""
         # TODO there's some ISUPPORT extension that lists /all/ channel modes
         # on each name that comes back...  support that?
-        self.send_message('NAMES', channel_name)
-
-        # No need to do the same thing twice
-        if channel_name in self._names_futures:
-            return self._names_futures[channel_name]
-
-        # Clear out any lingering names list
-        self._pending_names[channel_name] = []
+        messages = yield from self.send_request(
+            'NAMES', channel_name,
+            replies=['RPL_NAMREPLY'],
+            finish=['RPL_ENDOFNAMES'],
+            target=channel_name,
+        )
 
-        # Return a Future, to be populated by the message loop
-        fut = self._names_futures[channel_name] = asyncio.Future()
-        return fut
+        names = []
+        for message in messages:
+            if message.command == 'RPL_NAMREPLY' and len(message.args) > 3:
+                names.extend(message.args[3].strip(' ').split(' '))
+        return names
 
     def set_topic(self, channel, topic):
         """Sets the channel topic."""
@@ -535,10 +1763,87 @@ class IRCClient:
 
     # TODO unclear whether this stuff should be separate or what; it's less
     # about the protocol and more about the dywypi interface
-    def send_message(self, command, *args):
-        message = IRCMessage(command, *args)
+    def send_message(self, command, *args, tags=None, priority=None):
+        """Send a message to the server, subject to flood control.  `priority`
+        is one of the ``PRIORITY_*`` constants from
+        `dywypi.dialect.irc.flood`; by default it's picked based on the
+        command.
+        """
+        if priority is None:
+            priority = COMMAND_PRIORITIES.get(command, PRIORITY_COMMAND)
+        if tags and 'message-tags' not in self.capabilities:
+            # Client-only tags (prefixed with +) are only allowed once the
+            # server has agreed to relay them
+            tags = {
+                key: value for key, value in tags.items()
+                if not key.startswith('+')
+            }
+        message = IRCMessage(command, *args, tags=tags)
         log.debug("sent: %r", message)
-        self._writer.write(message.render().encode(self.charset) + b'\r\n')
+
+        # Chatter is queued per target, so one busy channel can't hold up
+        # all the others
+        target = None
+        if priority == PRIORITY_CHATTER and args:
+            target = self._fold_name(args[0])
+
+        self.send_queue.send(
+            message.render().encode(self.charset) + b'\r\n',
+            priority, target)
+
+    @property
+    def write_buffer_size(self):
+        """Number of bytes written to the connection that haven't been sent
+        yet.  Lines still held back by flood control don't count.
+        """
+        return self._writer.transport.get_write_buffer_size()
+
+    @asyncio.coroutine
+    def drain(self):
+        """Coroutine that nonblocks while the connection has more than
+        `write_buffer_high` bytes waiting to be sent, until it's back down to
+        `write_buffer_low`.
+        """
+        yield from self._writer.drain()
+
+    def _write(self, data):
+        """Write to the connection; used by flood control."""
+        self._writer.write(data)
+        if (self._stall_timer is None and
+                self.write_buffer_size > self.write_buffer_high):
+            self._stall_timer = self.loop.call_later(
+                self.write_stall_timeout, self._check_write_stall,
+                self._writer)
+
+    def _check_write_stall(self, writer):
+        self._stall_timer = None
+        if writer is not self._writer:
+            # Already reconnected
+            return
+
+        buffered = self.write_buffer_size
+        if buffered > self.write_buffer_low:
+            log.warning(
+                "Server hasn't read %d bytes in %ss; dropping connection",
+                buffered, self.write_stall_timeout)
+            # The read loop will see the connection close and reconnect
+            writer.transport.abort()
+
+    def _lag_timed_out(self):
+        # Nothing's coming back, whatever the socket thinks; the read loop
+        # will see the connection close and reconnect
+        self._writer.transport.abort()
+
+    def _cancel_stall_timer(self):
+        if self._stall_timer is not None:
+            self._stall_timer.cancel()
+            self._stall_timer = None
+
+    def _render_omitted(self, target, count):
+        """Line to send in place of output dropped by flood control."""
+        message = IRCMessage(
+            'NOTICE', target, "({} more lines omitted)".format(count))
+        return message.render().encode(self.charset) + b'\r\n'
 
     def format_transition(self, current_style, new_style):
         if new_style == Style.default():
@@ -0,0 +1,227 @@
+"""Outgoing flood control.
+
+IRC servers don't take kindly to clients that send too much too fast: go over
+the limit and you'll be throttled, or disconnected, or K-lined.  So everything
+the client sends goes through a token bucket, which allows a short burst and
+then paces the rest.
+
+Lines waiting their turn are queued per target (channel or nick), and targets
+take turns, so one channel being flooded with output doesn't hold up replies
+everywhere else.
+"""
+from collections import defaultdict
+from collections import deque
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# Priority lanes, most urgent first.  Protocol traffic (PONG, registration,
+# capability negotiation) is never held back at all; everything else waits
+# its turn, with commands going ahead of plugin chatter.
+PRIORITY_PROTOCOL = 0
+PRIORITY_COMMAND = 1
+PRIORITY_CHATTER = 2
+
+# What to do with new lines for a target whose queue is already full: throw
+# away the new line, throw away the oldest queued line, or throw away the new
+# line and send a summary of how many were lost once the queue drains.
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_COLLAPSE = 'collapse'
+
+
+class _FairQueue:
+    """A single priority lane: one queue per target, served round-robin.  A
+    target with a weight of N gets to send N lines per turn.
+    """
+    def __init__(self, *, max_depth, overflow, weights, collapse):
+        self.max_depth = max_depth
+        self.overflow = overflow
+        self.weights = weights
+        self.collapse = collapse
+
+        self._queues = {}  # target => deque of (data, queued_at)
+        self._order = deque()  # targets with something queued, in turn order
+        self._served = 0  # lines sent by the target at the head this turn
+        self._omitted = defaultdict(int)  # target => lines dropped
+        self.depth = 0
+
+    def __bool__(self):
+        return self.depth > 0
+
+    def push(self, target, item):
+        """Queue a line.  Returns the number of lines dropped to make room."""
+        queue = self._queues.get(target)
+        if queue is None:
+            queue = self._queues[target] = deque()
+            self._order.append(target)
+
+        if self.max_depth and len(queue) >= self.max_depth:
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                queue.popleft()
+                queue.append(item)
+            elif self.overflow == OVERFLOW_COLLAPSE and self.collapse:
+                self._omitted[target] += 1
+            return 1
+
+        queue.append(item)
+        self.depth += 1
+        return 0
+
+    def pop(self):
+        target = self._order[0]
+        queue = self._queues[target]
+        item = queue.popleft()
+        self.depth -= 1
+        self._served += 1
+
+        if not queue and target in self._omitted:
+            # Let the target know what it missed, as its last line
+            omitted = self._omitted.pop(target)
+            queue.append((self.collapse(target, omitted), item[1]))
+            self.depth += 1
+
+        if not queue:
+            del self._queues[target]
+            self._order.popleft()
+            self._served = 0
+        elif self._served >= self.weights.get(target, 1):
+            self._order.rotate(-1)
+            self._served = 0
+
+        return item
+
+    def clear(self):
+        self._queues.clear()
+        self._order.clear()
+        self._omitted.clear()
+        self._served = 0
+        self.depth = 0
+
+
+class FloodControl:
+    """Token-bucket send queue for a single connection.
+
+    Up to `burst` lines can go out back to back; after that, lines are
+    released at `rate` per second.  `write` is called with each line's bytes
+    when it's actually sent.
+
+    Each target may have at most `max_target_depth` lines waiting (0 for no
+    limit), with `overflow` saying what happens past that.  `weights` maps
+    targets to how many lines they may send per turn, if not 1.  `collapse`
+    is called with a target and a number of dropped lines, and returns the
+    bytes to send in their place, for OVERFLOW_COLLAPSE.
+    """
+    def __init__(self, loop, write, *, burst=5, rate=0.5,
+            max_target_depth=0, overflow=OVERFLOW_DROP_NEWEST, weights=None,
+            collapse=None):
+        if burst < 1:
+            raise ValueError("burst must be at least 1, not {!r}".format(burst))
+        if rate <= 0:
+            raise ValueError("rate must be positive, not {!r}".format(rate))
+
+        self.loop = loop
+        self._write = write
+        self.burst = burst
+        self.rate = rate
+
+        self._tokens = burst
+        self._last_refill = loop.time()
+        self._lanes = tuple(
+            _FairQueue(
+                max_depth=max_target_depth,
+                overflow=overflow,
+                weights=weights or {},
+                collapse=collapse,
+            )
+            for _ in range(3)
+        )
+        self._timer = None
+
+        # Metrics
+        self.dropped_count = 0
+        self.sent_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        """Number of lines waiting to be sent."""
+        return sum(lane.depth for lane in self._lanes)
+
+    @property
+    def depth_by_priority(self):
+        return [lane.depth for lane in self._lanes]
+
+    @property
+    def mean_wait(self):
+        """Average time, in seconds, lines have spent waiting to be sent."""
+        if not self.sent_count:
+            return 0.0
+        return self.total_wait / self.sent_count
+
+    def send(self, data, priority=PRIORITY_COMMAND, target=None):
+        """Send `data`, now if possible, or later if we're over the limit.
+        `target` is whatever the line is addressed to, if anything, and
+        should already be normalized.
+        """
+        if priority == PRIORITY_PROTOCOL:
+            # Doesn't wait, and doesn't count against the bucket either; being
+            # late with a PONG is far worse than being a little over
+            self._sent(0.0)
+            self._write(data)
+            return
+
+        self.dropped_count += self._lanes[priority].push(
+            target, (data, self.loop.time()))
+        depth = self.depth
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if self._timer is None:
+            self._drain()
+
+    def set_weights(self, weights):
+        """Replace the per-target `weights`."""
+        for lane in self._lanes:
+            lane.weights = weights
+
+    def close(self):
+        """Stop sending, and throw away anything still waiting."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for lane in self._lanes:
+            if lane:
+                log.debug("Dropping %d unsent lines", lane.depth)
+            lane.clear()
+
+    def _refill(self):
+        now = self.loop.time()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+        return now
+
+    def _drain(self):
+        self._timer = None
+        now = self._refill()
+
+        for lane in self._lanes:
+            while lane and self._tokens >= 1:
+                data, queued_at = lane.pop()
+                self._tokens -= 1
+                self._sent(now - queued_at)
+                self._write(data)
+
+        if any(self._lanes):
+            # Come back when there'll be another token
+            delay = (1 - self._tokens) / self.rate
+            self._timer = self.loop.call_later(delay, self._drain)
+
+    def _sent(self, wait):
+        self.sent_count += 1
+        self.total_wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
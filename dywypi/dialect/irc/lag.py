@@ -0,0 +1,133 @@
+"""Lag monitoring.
+
+Servers PING us to make sure we're alive, but nothing checks that the server
+is.  So the client PINGs the server on a schedule too, and times how long the
+PONG takes: a slow PONG means an overloaded server, and no PONG at all means
+the connection is dead, even if the socket hasn't noticed yet.
+"""
+from bisect import bisect_left
+from collections import deque
+import itertools
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# Upper bounds, in seconds, of the buckets in `LagMonitor.histogram`
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class LagMonitor:
+    """PINGs the server every `interval` seconds and times the PONGs.
+
+    `send_ping` is called with a token to send as a PING; the PONG's token
+    should be passed to `pong`.  If a PING goes unanswered for `timeout`
+    seconds, `on_dead` is called, and no more PINGs are sent.  The last
+    `samples` round trips are kept, for `percentile` and `histogram`.
+    """
+    def __init__(self, loop, send_ping, on_dead, *, interval=60, timeout=120,
+            samples=100):
+        self.loop = loop
+        self._send_ping = send_ping
+        self._on_dead = on_dead
+        self.interval = interval
+        self.timeout = timeout
+
+        self.samples = deque(maxlen=samples)
+        self.last_lag = None
+        self._pending = {}  # token => time sent
+        self._tokens = itertools.count()
+        self._timer = None
+        self._deadline = None
+
+    def start(self):
+        """Send the first PING right away, and keep going from there."""
+        self.stop()
+        self._ping()
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._deadline is not None:
+            self._deadline.cancel()
+            self._deadline = None
+        self._pending.clear()
+
+    @property
+    def lag(self):
+        """Current lag, in seconds: the last round trip, or how long the
+        oldest unanswered PING has been waiting, whichever is longer.  None
+        if there's nothing to go on yet.
+        """
+        lag = self.last_lag
+        if self._pending:
+            waiting = self.loop.time() - min(self._pending.values())
+            if lag is None or waiting > lag:
+                lag = waiting
+        return lag
+
+    def percentile(self, percent):
+        """The given percentile of recent round trips, in seconds, or None if
+        there haven't been any.
+        """
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index]
+
+    def histogram(self):
+        """Count of recent round trips falling into each of
+        `HISTOGRAM_BUCKETS`, as a list of (upper bound, count).
+        """
+        counts = [0] * len(HISTOGRAM_BUCKETS)
+        for sample in self.samples:
+            counts[bisect_left(HISTOGRAM_BUCKETS, sample)] += 1
+        return list(zip(HISTOGRAM_BUCKETS, counts))
+
+    def pong(self, token):
+        """Record a PONG.  Returns False if it wasn't for one of our PINGs."""
+        sent = self._pending.pop(token, None)
+        if sent is None:
+            return False
+
+        self.last_lag = self.loop.time() - sent
+        self.samples.append(self.last_lag)
+        # PONGs come back in order, so anything older is never coming
+        for old_token, old_sent in list(self._pending.items()):
+            if old_sent <= sent:
+                del self._pending[old_token]
+        if not self._pending and self._deadline is not None:
+            self._deadline.cancel()
+            self._deadline = None
+        return True
+
+    def _ping(self):
+        token = 'dywypi-lag-{}'.format(next(self._tokens))
+        now = self.loop.time()
+        self._pending[token] = now
+        self._send_ping(token)
+
+        if self._deadline is None:
+            self._deadline = self.loop.call_later(
+                self.timeout, self._check_deadline)
+        self._timer = self.loop.call_later(self.interval, self._ping)
+
+    def _check_deadline(self):
+        self._deadline = None
+        if not self._pending:
+            return
+
+        oldest = min(self._pending.values())
+        remaining = oldest + self.timeout - self.loop.time()
+        if remaining > 0:
+            # The PING we were waiting on came back, but a newer one hasn't
+            self._deadline = self.loop.call_later(
+                remaining, self._check_deadline)
+            return
+
+        log.warning("No PONG in %ss; assuming the connection is dead",
+            self.timeout)
+        self.stop()
+        self._on_dead()
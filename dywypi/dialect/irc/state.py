@@ -1,15 +1,269 @@
+from collections.abc import MutableMapping
+import logging
+from string import ascii_lowercase, ascii_uppercase
+
+from dywypi.state import Peer
+
+log = logging.getLogger(__name__)
+
 UNKNOWN = object()
 
 
+class CaseMapping:
+    """One of the ways a server can decide which nicks and channel names are
+    the same, as named by ISUPPORT's CASEMAPPING.  `fold` turns a name into
+    its normal form.
+
+    Folded names are cached, since the same few names come up over and over;
+    looking one up is then a dict hit instead of a new string.
+    """
+    # Past this many names, the cache starts over rather than growing forever
+    cache_size = 10000
+
+    def __init__(self, name, upper, lower):
+        self.name = name
+        self.table = str.maketrans(upper, lower)
+        self._cache = {}
+
+    def fold(self, name):
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        folded = self._cache[name] = name.translate(self.table)
+        return folded
+
+
+CASEMAPPINGS = {
+    mapping.name: mapping
+    for mapping in (
+        CaseMapping('ascii', ascii_uppercase, ascii_lowercase),
+        # Scandinavian legacy: []\ are the uppercase forms of {}|
+        CaseMapping('strict-rfc1459',
+            ascii_uppercase + '[]\\', ascii_lowercase + '{}|'),
+        # ...and ~ of ^, which is what most servers mean by rfc1459
+        CaseMapping('rfc1459',
+            ascii_uppercase + '[]\\~', ascii_lowercase + '{}|^'),
+    )
+}
+
+
+class IRCDict(MutableMapping):
+    """Dict keyed by nicks or channel names, which treats keys as the same
+    when they `fold` to the same thing.  Iterating gives back keys as they
+    were last set, so they're still fit for display.
+    """
+    def __init__(self, fold):
+        self.fold = fold
+        self._data = {}  # folded key => (key, value)
+
+    def __getitem__(self, key):
+        return self._data[self.fold(key)][1]
+
+    def __setitem__(self, key, value):
+        self._data[self.fold(key)] = key, value
+
+    def __delitem__(self, key):
+        del self._data[self.fold(key)]
+
+    def __contains__(self, key):
+        return self.fold(key) in self._data
+
+    def __iter__(self):
+        return (key for key, value in self._data.values())
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(type(self).__name__, dict(self.items()))
+
+    def clear(self):
+        self._data.clear()
+
+
 class IRCMode:
     def __init__(self, letter, *,
-            prefix=None, arg_on_set=False, arg_on_remove=False, multi=False):
+            prefix=None, bit=0, arg_on_set=False, arg_on_remove=False,
+            multi=False):
         self.letter = letter
         self.prefix = prefix
+        # Prefix modes only: this mode's bit in a user's mode mask.  Lower
+        # bits are higher ranks, following the order in PREFIX.
+        self.bit = bit
         self.arg_on_set = multi or arg_on_set
         self.arg_on_remove = multi or arg_on_remove
         self.multi = multi
 
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.letter)
+
+
+class IRCModeChange:
+    """A single mode being set or unset, as part of a MODE line.  `arg` is
+    None if the mode didn't take one.
+    """
+    def __init__(self, mode, adding, arg=None):
+        self.mode = mode
+        self.adding = adding
+        self.arg = arg
+
+    @property
+    def letter(self):
+        return self.mode.letter
+
+    def __repr__(self):
+        return '<{} {}{}{}>'.format(
+            type(self).__name__, '+' if self.adding else '-', self.letter,
+            '' if self.arg is None else ' ' + self.arg)
+
+
+def parse_mode_changes(modes, modestring, args):
+    """Parse a mode string and its arguments, like those of a MODE line, into
+    a list of `IRCModeChange`s.  `modes` maps letters to `IRCMode`s and says
+    which modes take arguments.  A letter not in it is assumed to take none,
+    since there's no way to know otherwise.
+    """
+    changes = []
+    args = iter(args)
+    adding = True
+    for letter in modestring:
+        if letter == '+':
+            adding = True
+            continue
+        if letter == '-':
+            adding = False
+            continue
+
+        mode = modes.get(letter)
+        if mode is None:
+            log.warning("Unknown channel mode %r", letter)
+            mode = IRCMode(letter)
+        if mode.arg_on_set if adding else mode.arg_on_remove:
+            arg = next(args, None)
+        else:
+            arg = None
+        changes.append(IRCModeChange(mode, adding, arg))
+
+    return changes
+
+
+def split_prefix(prefix):
+    """Split a prefix of the form nick!ident@host into its three parts.  The
+    ident and host are None if they're missing, as in a NAMES reply.
+    """
+    nick, _, identhost = prefix.partition('!')
+    if not identhost:
+        return nick, None, None
+    ident, _, host = identhost.partition('@')
+    return nick, ident, host
+
+
+class IRCUserRegistry:
+    """Every user sharing a channel with us on one connection, as a single
+    `Peer` each, no matter how many channels they're in.  Keyed by nick,
+    normalized with `fold`.
+
+    A user's record lives as long as they're in at least one of our
+    channels; after that it's forgotten.
+    """
+    def __init__(self, fold):
+        self.fold = fold
+        self._users = {}  # folded nick => Peer
+        self._channels = {}  # folded nick => set of folded channel names
+
+    def __len__(self):
+        return len(self._users)
+
+    def __iter__(self):
+        return iter(self._users.values())
+
+    def __contains__(self, nick):
+        return self.fold(nick) in self._users
+
+    def get(self, nick):
+        return self._users.get(self.fold(nick))
+
+    def from_prefix(self, prefix):
+        """Return the `Peer` for a message prefix.  If it's someone we know,
+        that's their shared record, updated with anything new in the prefix;
+        otherwise it's a fresh `Peer` that isn't kept anywhere.
+        """
+        nick, ident, host = split_prefix(prefix)
+        peer = self._users.get(self.fold(nick))
+        if peer is None:
+            return Peer.from_prefix(prefix)
+        self._update(peer, nick, ident, host)
+        return peer
+
+    def add(self, channel_name, nick, ident=None, host=None):
+        """Record that a user is in one of our channels, and return their
+        shared `Peer`.
+        """
+        key = self.fold(nick)
+        peer = self._users.get(key)
+        if peer is None:
+            peer = self._users[key] = Peer(nick, ident, host)
+            self._channels[key] = set()
+        else:
+            self._update(peer, nick, ident, host)
+        self._channels[key].add(self.fold(channel_name))
+        return peer
+
+    def remove(self, channel_name, nick):
+        """Record that a user has left one of our channels.  Returns their
+        `Peer`, or None if we didn't know about them.
+        """
+        key = self.fold(nick)
+        channels = self._channels.get(key)
+        if channels is None:
+            return None
+        channels.discard(self.fold(channel_name))
+        if channels:
+            return self._users[key]
+        del self._channels[key]
+        return self._users.pop(key)
+
+    def forget(self, nick):
+        """Drop a user entirely, e.g. because they quit.  Returns the names
+        of the channels they were in.
+        """
+        key = self.fold(nick)
+        self._users.pop(key, None)
+        return self._channels.pop(key, frozenset())
+
+    def rename(self, old_nick, new_nick):
+        """Move a user's record to a new nick.  Returns their `Peer`, or None
+        if we didn't know about them.
+        """
+        old_key = self.fold(old_nick)
+        peer = self._users.pop(old_key, None)
+        if peer is None:
+            return None
+        new_key = self.fold(new_nick)
+        peer.name = new_nick
+        self._users[new_key] = peer
+        self._channels[new_key] = self._channels.pop(old_key)
+        return peer
+
+    def channels_of(self, nick):
+        """Names of our channels the given user is in, folded."""
+        return self._channels.get(self.fold(nick), frozenset())
+
+    def clear(self):
+        self._users.clear()
+        self._channels.clear()
+
+    def _update(self, peer, nick, ident, host):
+        # Nicks are compared case-insensitively, but might have changed case
+        peer.name = nick
+        if ident is not None:
+            peer.ident = ident
+            peer.host = host
+
 
 class IRCTopic:
     def __init__(self, text, author=None, timestamp=None):
@@ -25,9 +279,97 @@ class IRCChannel:
         self.client = client
         self.name = name
         self.key = key
-        self.users = {}
+        self.users = IRCDict(client._fold_name)  # name => Peer
+        # name => mask of `IRCMode.bit`s; most users have no modes at all, and
+        # are left out
+        self.user_modes = IRCDict(client._fold_name)
+        # Mode letter => argument, or True for modes without one
+        self.modes = {}
+        # List mode letter => set of masks; e.g. b for bans
+        self.lists = {}
         self.topic = None
         self.sync = False
 
-    def add_user(self, user, modes=()):
-        self.users[user.name] = user, set(modes)
+    def add_user(self, user, modes=0):
+        """Add a user, with a mask of the prefix modes they have."""
+        self.users[user.name] = user
+        if modes:
+            self.user_modes[user.name] = modes
+        else:
+            self.user_modes.pop(user.name, None)
+
+    def remove_user(self, name):
+        """Forget a user who's left.  Returns their `Peer`, or None."""
+        self.user_modes.pop(name, None)
+        return self.users.pop(name, None)
+
+    def rename_user(self, old_name, new_name):
+        user = self.users.pop(old_name, None)
+        if user is None:
+            return
+        self.users[new_name] = user
+        modes = self.user_modes.pop(old_name, 0)
+        if modes:
+            self.user_modes[new_name] = modes
+
+    def set_user_mode(self, name, mode, on):
+        """Give or take away one of a user's prefix modes, as an `IRCMode`."""
+        if name not in self.users:
+            return
+        modes = self.user_modes.get(name, 0)
+        if on:
+            modes |= mode.bit
+        else:
+            modes &= ~mode.bit
+
+        if modes:
+            self.user_modes[name] = modes
+        else:
+            del self.user_modes[name]
+
+    def has_mode(self, name, letter):
+        """Whether a user has a prefix mode, by letter; e.g. o for op."""
+        mode = self.client.channel_modes.get(letter)
+        if mode is None:
+            return False
+        return bool(self.user_modes.get(name, 0) & mode.bit)
+
+    def highest_prefix(self, name):
+        """The symbol for a user's highest-ranked prefix mode, e.g. @, or None
+        if they have none.
+        """
+        modes = self.user_modes.get(name, 0)
+        if not modes:
+            return None
+        # Lowest set bit is the highest rank
+        rank = (modes & -modes).bit_length() - 1
+        return self.client.prefix_modes[rank].prefix
+
+    def set_mode(self, letter, arg, on):
+        if on:
+            self.modes[letter] = True if arg is None else arg
+        else:
+            self.modes.pop(letter, None)
+
+        if letter == 'k':
+            self.key = arg if on else None
+
+    def apply_mode_changes(self, changes):
+        """Update the channel from a list of `IRCModeChange`s."""
+        for change in changes:
+            mode = change.mode
+            if mode.prefix:
+                self.set_user_mode(change.arg, mode, change.adding)
+            elif mode.multi:
+                if change.arg is None:
+                    # Asking for the list, not changing it
+                    continue
+                masks = self.lists.get(mode.letter)
+                if masks is None:
+                    masks = self.lists[mode.letter] = set()
+                if change.adding:
+                    masks.add(change.arg)
+                else:
+                    masks.discard(change.arg)
+            else:
+                self.set_mode(mode.letter, change.arg, change.adding)
@@ -1,5 +1,4 @@
 import asyncio
-from asyncio.queues import Queue
 from collections import defaultdict
 from collections import deque
 from datetime import datetime
@@ -10,6 +9,7 @@ import aiohttp
 import websockets
 
 from dywypi.event import Event
+from dywypi.queue import EventQueue
 
 log = logging.getLogger(__name__)
 
@@ -200,7 +200,13 @@ class ShowdownClient:
 
         self._read_loop_task = None
         self._current_room = None
-        self._event_queue = Queue(loop=self.loop)
+        # Raw messages may be dropped if the plugins fall behind; events
+        # about challenges and battles never are
+        self._event_queue = EventQueue(
+            self.loop,
+            droppable=lambda event: isinstance(event, ShowdownMessage))
+        # See IRCClient.event_subscriptions
+        self.event_subscriptions = None
         self._awaiting_messages = defaultdict(deque)
         self._challenge = None
 
@@ -245,7 +251,9 @@ class ShowdownClient:
             while awaiting:
                 awaiting.popleft().set_result(None)
 
-            await self._event_queue.put(event)
+            subscriptions = self.event_subscriptions
+            if subscriptions is None or subscriptions.wants(type(event)):
+                await self._event_queue.put(event)
 
     async def read_event(self):
         return await self._event_queue.get()
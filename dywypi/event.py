@@ -56,3 +56,38 @@ class PrivateMessage(Message):
     """A private message.  Note that bot plugins will never receive this, as
     all private messages are currently assumed to be commands.
     """
+
+
+class ModeChange(Event):
+    """Someone changed a channel's modes.  `changes` is a list of the
+    individual modes set or unset, as the dialect understands them; on IRC,
+    these are `IRCModeChange`s.
+    """
+    def __init__(self, source, channel, changes, **kwargs):
+        super().__init__(**kwargs)
+
+        self.source = source
+        self.channel = channel
+        self.changes = changes
+
+
+class Connected(Event):
+    """The client has connected to a server and is ready to be used.  Fires
+    again after every reconnect.
+    """
+    def __init__(self, server, **kwargs):
+        super().__init__(**kwargs)
+
+        self.server = server
+
+
+class Disconnected(Event):
+    """The client lost its connection.  Anything sent until the next
+    `Connected` goes nowhere.  `reconnecting` says whether the client is
+    trying to get the connection back.
+    """
+    def __init__(self, server, *, reconnecting, **kwargs):
+        super().__init__(**kwargs)
+
+        self.server = server
+        self.reconnecting = reconnecting
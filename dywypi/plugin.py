@@ -112,6 +112,39 @@ class PluginManager:
     def __init__(self):
         self.loaded_plugins = {}
         self.plugin_data = defaultdict(PluginData)
+        # Event class => whether anything is listening; cleared on load
+        self._wanted_events = {}
+
+    def wants(self, event_cls):
+        """Whether any loaded plugin would be handed events of exactly this
+        class.  Clients can use this to avoid building events nobody will
+        ever see.
+        """
+        try:
+            return self._wanted_events[event_cls]
+        except KeyError:
+            pass
+
+        # Plugin.on already files listeners under the parents of the class
+        # they asked for, and firing only looks at the event's own class
+        wanted = any(
+            plugin.listeners.get(event_cls)
+            for plugin in self.loaded_plugins.values()
+            if isinstance(plugin, Plugin)
+        )
+        self._wanted_events[event_cls] = wanted
+        return wanted
+
+    @property
+    def wants_commands(self):
+        """Whether any loaded plugin has commands, i.e., whether messages
+        addressed to the bot need to be seen at all.
+        """
+        return any(
+            plugin.commands
+            for plugin in self.loaded_plugins.values()
+            if isinstance(plugin, Plugin)
+        )
 
     @property
     def known_plugins(self):
@@ -142,6 +175,7 @@ class PluginManager:
         #plugin.start()
         log.info("Loaded plugin {}".format(plugin.name))
         self.loaded_plugins[plugin.name] = plugin
+        self._wanted_events.clear()
 
     def loadmodule(self, modname):
         # This is a little chumptastic, but: figure out which plugins a module
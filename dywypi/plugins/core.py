@@ -24,3 +24,20 @@ def plugin_help(event):
         yield from event.reply(
             "Loaded plugins: {}".format(
                 ', '.join(manager.loaded_plugins.keys())))
+
+
+@plugin.command('lag')
+def plugin_lag(event):
+    monitor = getattr(event.client, 'lag_monitor', None)
+    if monitor is None or monitor.lag is None:
+        yield from event.reply("I haven't measured any lag yet.")
+        return
+
+    yield from event.reply(
+        "Lag: {:.3f}s (median {:.3f}s, 90th percentile {:.3f}s, "
+        "worst {:.3f}s of the last {})".format(
+            monitor.lag,
+            monitor.percentile(50) or 0,
+            monitor.percentile(90) or 0,
+            max(monitor.samples, default=0),
+            len(monitor.samples)))
@@ -0,0 +1,115 @@
+"""Bounded queue for events on their way from a client to the plugins.
+
+If plugins fall behind a busy network, events pile up here, and an unbounded
+queue would grow until the process runs out of memory.  So the queue has a
+size limit and a policy for what to do past it.  Only chatter is ever thrown
+away; events about the connection or protocol state always get through.
+"""
+import asyncio
+from collections import deque
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# What to do when the queue is full: make the reader wait for room, throw
+# away the oldest chatter to make room, or throw away the new chatter
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+
+
+class EventQueue:
+    """Queue of events, holding at most `maxsize` of them (0 for no limit).
+
+    `droppable` is called with an event and says whether it's chatter that
+    may be thrown away under one of the drop policies; anything else is
+    always queued, even past `maxsize`.
+    """
+    def __init__(self, loop, *, maxsize=1000, overflow=OVERFLOW_DROP_OLDEST,
+            droppable=lambda event: True):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.droppable = droppable
+
+        self._items = deque()
+        self._getters = deque()
+        self._putters = deque()
+
+        # Metrics
+        self.dropped_count = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+    def full(self):
+        return bool(self.maxsize) and len(self._items) >= self.maxsize
+
+    @asyncio.coroutine
+    def put(self, event):
+        """Coroutine that queues an event, waiting for room first if the
+        policy is `OVERFLOW_BLOCK`.
+        """
+        while self.overflow == OVERFLOW_BLOCK and self.full():
+            waiter = asyncio.Future(loop=self.loop)
+            self._putters.append(waiter)
+            yield from waiter
+        self.put_nowait(event)
+
+    def put_nowait(self, event):
+        """Queue an event without waiting.  If the queue is full, chatter is
+        dropped according to the policy; blocking isn't an option here, so
+        `OVERFLOW_BLOCK` lets the queue grow instead.
+        """
+        if self.full() and self.overflow != OVERFLOW_BLOCK:
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                for index, old_event in enumerate(self._items):
+                    if self.droppable(old_event):
+                        del self._items[index]
+                        self._dropped()
+                        break
+                else:
+                    if self.droppable(event):
+                        self._dropped()
+                        return
+            elif self.droppable(event):
+                self._dropped()
+                return
+
+        self._items.append(event)
+        if len(self._items) > self.max_depth:
+            self.max_depth = len(self._items)
+        self._wake(self._getters)
+
+    @asyncio.coroutine
+    def get(self):
+        """Coroutine that removes and returns the oldest event."""
+        while not self._items:
+            waiter = asyncio.Future(loop=self.loop)
+            self._getters.append(waiter)
+            yield from waiter
+        return self.get_nowait()
+
+    def get_nowait(self):
+        if not self._items:
+            raise asyncio.QueueEmpty
+        event = self._items.popleft()
+        self._wake(self._putters)
+        return event
+
+    def _wake(self, waiters):
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def _dropped(self):
+        if not self.dropped_count:
+            log.warning("Event queue is full; dropping chatter")
+        self.dropped_count += 1
@@ -1,6 +1,7 @@
 import asyncio
 import getpass
 import logging
+import ssl
 
 
 log = logging.getLogger(__name__)
@@ -16,6 +17,14 @@ class Network:
         self.servers = []
         self.autojoins = []
 
+        # TLS settings shared by all of this network's servers; see
+        # `configure_tls`
+        self.tls_ca_file = None
+        self.tls_cert_file = None
+        self.tls_key_file = None
+        self.tls_verify = True
+        self._ssl_context = None
+
     def add_preferred_nick(self, nick):
         self.nicks.append(nick)
 
@@ -37,7 +46,42 @@ class Network:
             else:
                 port = 6667
 
-        self.servers.append(Server(host, port, tls=tls, password=password))
+        self.servers.append(Server(
+            host, port, tls=tls, password=password, network=self))
+
+    def configure_tls(self, *, ca_file=None, cert_file=None, key_file=None,
+            verify=True):
+        """Change how TLS connections to this network's servers work.
+        `ca_file` is a bundle of CA certificates to trust instead of the
+        system's; `cert_file` and `key_file` are a client certificate to
+        present, e.g. for SASL EXTERNAL or CertFP.  Turning off `verify` is a
+        bad idea, but some networks leave you no choice.
+        """
+        self.tls_ca_file = ca_file
+        self.tls_cert_file = cert_file
+        self.tls_key_file = key_file
+        self.tls_verify = verify
+        self._ssl_context = None
+
+    @property
+    def ssl_context(self):
+        """The `ssl.SSLContext` used to connect to any of this network's
+        servers.  Built once and shared, so certificates are only loaded once
+        and sessions can be resumed on reconnect.
+        """
+        if self._ssl_context is None:
+            context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            if self.tls_ca_file:
+                context.load_verify_locations(cafile=self.tls_ca_file)
+            else:
+                context.load_default_certs()
+            if not self.tls_verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            if self.tls_cert_file:
+                context.load_cert_chain(self.tls_cert_file, self.tls_key_file)
+            self._ssl_context = context
+        return self._ssl_context
 
     def add_autojoin(self, channel_name):
         # TODO yet again, irc specific
@@ -48,14 +92,52 @@ class Network:
         self.autojoins.append(channel_name)
 
 
+class ResumingSSLContext(ssl.SSLContext):
+    """Client `ssl.SSLContext` that remembers the last TLS session for each
+    host, and offers it on the next connection to that host, so a reconnect
+    can skip the full handshake.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.sessions = {}  # hostname => ssl.SSLSession
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+            server_hostname=None, session=None):
+        # This is what asyncio calls to set up every TLS connection
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(
+            incoming, outgoing, server_side=server_side,
+            server_hostname=server_hostname, session=session)
+
+    def save_session(self, hostname, writer):
+        """Remember the session used by a connected stream.  With TLS 1.3,
+        the server only sends a resumable session after the handshake, so
+        this is best done once some data has come back.
+        """
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None and ssl_object.session is not None:
+            self.sessions[hostname] = ssl_object.session
+
+
 class Server:
     # TODO this is TCP only...
-    def __init__(self, host, port, tls, password):
+    def __init__(self, host, port, tls, password, *, network=None):
         self.host = host
         self.port = port
         self.tls = tls
         # TODO wait is this per-server or per-network
         self.password = password
+        self.network = network
+
+    @property
+    def ssl_context(self):
+        """What to pass as asyncio's `ssl` argument: the network's shared
+        context if there is one, or just whether to use TLS at all.
+        """
+        if self.tls and self.network is not None:
+            return self.network.ssl_context
+        return self.tls
 
     def connect(self, loop):
         """Return a coroutine that, when yield from'd, will connect to this
@@ -64,10 +146,19 @@ class Server:
         return asyncio.open_connection(
             host=self.host,
             port=self.port,
-            ssl=self.tls,
+            ssl=self.ssl_context,
             loop=loop,
         )
 
+    def save_tls_session(self, writer):
+        """Remember the TLS session of a connection to this server, so the
+        next one can resume it.
+        """
+        context = self.ssl_context
+        if isinstance(context, ResumingSSLContext):
+            context.save_session(self.host, writer)
+
+
 class Peer:
     def __init__(self, name, ident, host, *, is_server=False):
         self.name = name
@@ -75,6 +166,10 @@ class Peer:
         self.host = host
         self.is_server = is_server
 
+        # Services account and away message, where the protocol tells us
+        self.account = None
+        self.away = None
+
     # TODO this should definitely not be here
     @classmethod
     def from_prefix(cls, prefix):
@@ -84,7 +179,7 @@ class Peer:
         if '!' in prefix:
             # Another user: name!ident@host
             name, identhost = prefix.split('!', 1)
-            ident, host = prefix.split('@', 1)
+            ident, host = identhost.split('@', 1)
             return cls(name, ident, host)
         else:
             # Must be a server talking to us
@@ -11,19 +11,39 @@ from dywypi.state import Network
 class DummyTransport(asyncio.WriteTransport):
     def __init__(self):
         self.buf = BytesIO()
+        # Pretend this much is stuck waiting to be sent
+        self.buffered = 0
+        self.aborted = False
 
     def write(self, data):
         self.buf.write(data)
 
+    def close(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def abort(self):
+        self.aborted = True
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
 
 class FakeServer(object):
+    host = 'localhost'
+    port = 6667
     password = None
 
     @asyncio.coroutine
     def connect(self, loop):
         self.reader = asyncio.StreamReader(loop=loop)
         transport = DummyTransport()
-        protocol = asyncio.Protocol()
+        protocol = asyncio.StreamReaderProtocol(self.reader, loop=loop)
         writer = asyncio.StreamWriter(transport, protocol, self.reader, loop)
 
         # Keep with the future-like interface
@@ -31,6 +51,9 @@ class FakeServer(object):
         fut.set_result((self.reader, writer))
         return fut
 
+    def save_tls_session(self, writer):
+        pass
+
     def feed_irc(self, *args):
         """Used in tests.  Push an entire IRC-style command into the client, as
         though it had come over the network.
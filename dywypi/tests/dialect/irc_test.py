@@ -2,15 +2,30 @@ import asyncio
 
 @asyncio.coroutine
 def test_message_parsing(loop, client, fake_server):
+    seen = []
+    client.add_handler('COMMAND', lambda client, message: seen.append(message))
     fake_server.reader.feed_data(b":prefix!ident@host COMM")
     fake_server.reader.feed_data(b"AND arg1 arg2 :extra arguments...\r\njunk")
-    message, event = yield from client.read_queue.get()
-    assert message
+    yield from asyncio.sleep(0, loop=loop)
+    message, = seen
     assert message.command == 'COMMAND'
     assert message.prefix == 'prefix!ident@host'
     assert message.args == ('arg1', 'arg2', 'extra arguments...')
 
 
+@asyncio.coroutine
+def test_message_batch(loop, client, fake_server):
+    # Several lines in one read, with a bare LF and a line split across reads
+    commands = []
+    for command in ('ONE', 'TWO', 'THREE'):
+        client.add_handler(
+            command, lambda client, message: commands.append(message.command))
+    fake_server.reader.feed_data(b"ONE 1\r\nTWO 2\nTHR")
+    fake_server.reader.feed_data(b"EE 3\r\n")
+    yield from asyncio.sleep(0, loop=loop)
+    assert commands == ['ONE', 'TWO', 'THREE']
+
+
 @asyncio.coroutine
 def test_gather_messages(loop, client, fake_server):
     # Hypothetical stuff still in the pipe that's not yet a response to us
@@ -55,3 +70,875 @@ def test_names(loop, client, fake_server):
 
     assert len(names) == 3
     # TODO assert the specific names once the sigil parsing is done
+
+
+@asyncio.coroutine
+def test_names_keeps_topic(loop, client, fake_server):
+    nick = client.nick.encode('utf8')
+    fake_server.reader.feed_data(
+        b':' + nick + b'!u@h JOIN #bot\r\n'
+        b':irc 332 ' + nick + b' #bot :Welcome to #bot\r\n'
+        b':irc 353 ' + nick + b' = #bot :' + nick + b'\r\n'
+        b':irc 366 ' + nick + b' #bot :End of /NAMES list.\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+    channel = client.joined_channels['#bot']
+    assert channel.topic.text == 'Welcome to #bot'
+
+    names = asyncio.async(client.names('#bot'), loop=loop)
+    yield from asyncio.sleep(0, loop=loop)
+    fake_server.reader.feed_data(
+        b':irc 353 ' + nick + b' = #bot :' + nick + b' eevee\r\n'
+        b':irc 366 ' + nick + b' #bot :End of /NAMES list.\r\n')
+    assert len((yield from names)) == 2
+    assert channel.topic.text == 'Welcome to #bot'
+
+
+# A mix of real traffic and various edge cases.  The fast and strict parsers
+# must agree on every one of these.
+PARSE_CORPUS = [
+    'PING :irc.veekun.com',
+    ':irc.veekun.com 001 dywypi :Welcome to the veekun IRC Network dywypi!dywypi@localhost',
+    ':irc.veekun.com 005 dywypi CHANTYPES=# PREFIX=(qaohv)~&@%+ NETWORK=veekun :are supported by this server',
+    ':irc.veekun.com 353 dywypi = #bot :@eevee +dywypi someone',
+    ':eevee!eevee@b.d.f.l PRIVMSG #bot :dywypi: echo  spaced  out  ',
+    ':eevee!eevee@b.d.f.l PRIVMSG #bot ::starts with a colon',
+    ':eevee!eevee@b.d.f.l PRIVMSG #bot :',
+    ':eevee!eevee@b.d.f.l PRIVMSG #bot :a :b :c',
+    ':eevee!eevee@b.d.f.l JOIN #bot',
+    ':eevee!eevee@b.d.f.l MODE #bot +o dywypi',
+    ':eevee!eevee@b.d.f.l   MODE   #bot   +b   a!b@c  ',
+    ':eevee!eevee@b.d.f.l KICK #bot someone:with:colons :bye',
+    'NOTICE AUTH :*** Looking up your hostname...',
+    'ERROR :Closing Link: dywypi (Quit: Seeya!)',
+    'SOME_COMMAND',
+    'SOME_COMMAND    ',
+    'CMD arg\twith\ttabs',
+]
+
+PARSE_CORPUS_INVALID = [
+    '',
+    ' PING :foo',
+    ':prefix',
+    ':prefix ',
+    ': PING',
+    '1234 foo',
+    'PING123 foo',
+    'CMD\targ',
+    ':prefix :trailing',
+    'PRIVMSG #bot :nul\x00byte',
+    'PRIVMSG #b\rot :text',
+]
+
+
+def test_message_parse_fast_matches_strict():
+    from dywypi.dialect.irc.message import IRCMessage
+
+    for line in PARSE_CORPUS:
+        fast = IRCMessage.parse(line)
+        strict = IRCMessage.parse(line, strict=True)
+        assert fast.prefix == strict.prefix, line
+        assert fast.command == strict.command, line
+        assert fast.numeric == strict.numeric, line
+        assert fast.args == strict.args, line
+
+        raw = IRCMessage.parse_bytes(line.encode('utf8'))
+        assert raw.prefix == strict.prefix, line
+        assert raw.command == strict.command, line
+        assert raw.args == strict.args, line
+
+    for line in PARSE_CORPUS_INVALID:
+        for strict in (False, True):
+            try:
+                IRCMessage.parse(line, strict=strict)
+            except ValueError:
+                pass
+            else:
+                assert False, "parsed invalid line {!r}".format(line)
+
+
+def test_message_parse_bytes_defers_decoding():
+    from dywypi.dialect.irc.message import IRCMessage
+
+    line = b':eevee!eevee@b.d.f.l PRIVMSG #bot :caf\xe9 \xe2\x98\x83'
+    message = IRCMessage.parse_bytes(line)
+    assert message.command == 'PRIVMSG'
+    assert message.prefix == 'eevee!eevee@b.d.f.l'
+    # Nothing has looked at the text yet, so it's still raw
+    assert message._raw_trailing is not None
+    assert message.arg(0) == '#bot'
+    assert message._raw_trailing is not None
+
+    # Invalid UTF-8 is replaced rather than losing the whole message
+    assert message.args == ('#bot', 'caf\ufffd \u2603')
+    assert message._raw_trailing is None
+
+
+@asyncio.coroutine
+def test_overlong_line(loop, client, fake_server):
+    seen = []
+    client.add_handler(
+        'PRIVMSG', lambda client, message: seen.append(message.args[1]))
+    client.max_line_length = 1000
+
+    # A server that never sends a newline can't make us buffer forever
+    fake_server.reader.feed_data(b':a!b@c PRIVMSG #bot :' + b'x' * 5000)
+    yield from asyncio.sleep(0, loop=loop)
+    assert len(client._read_buffer) <= 1000
+    fake_server.reader.feed_data(b'x' * 500 + b'\r\n:a!b@c PRIVMSG #bot :ok\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+
+    assert seen == ['ok']
+
+
+@asyncio.coroutine
+def test_add_handler(loop, client, fake_server):
+    seen = []
+
+    def handle_whoisuser(client, message):
+        seen.append(message.args[1])
+
+    # Registered by numeric, but the message arrives by name
+    assert client.add_handler('311', handle_whoisuser) is None
+    fake_server.feed_irc('311', 'dywypi', 'eevee', 'eevee', 'b.d.f.l', '*', 'I solve practical problems')
+    yield from asyncio.sleep(0, loop=loop)
+    assert seen == ['eevee']
+
+    # Replacing a built-in handler hands back the original
+    old_handler = client.add_handler('PING', lambda client, message: None)
+    assert old_handler is type(client)._handle_PING
+
+
+@asyncio.coroutine
+def test_concurrent_whois(loop, client, fake_server):
+    # Three whoises in flight at once, one of them for ourselves, with their
+    # replies interleaved, and an unrelated error in the middle
+    me = client.nick
+    whois_me = asyncio.async(client.whois(me), loop=loop)
+    whois_eevee = asyncio.async(client.whois('eevee'), loop=loop)
+    whois_fred = asyncio.async(client.whois('FRED'), loop=loop)
+    yield from asyncio.sleep(0, loop=loop)
+
+    fake_server.feed_irc('311', me, 'eevee', 'eevee', 'b.d.f.l', '*', 'Eevee')
+    fake_server.feed_irc('311', me, 'fred', 'fred', 'bedrock', '*', 'Fred')
+    fake_server.feed_irc('404', me, '#bot', 'Cannot send to channel')
+    fake_server.feed_irc('401', me, 'nobody', 'No such nick/channel')
+    fake_server.feed_irc('318', me, 'fred', 'End of /WHOIS list.')
+    fake_server.feed_irc('318', me, 'eevee', 'End of /WHOIS list.')
+    fake_server.feed_irc('311', me, me, 'dywypi', 'localhost', '*', 'Bot')
+    fake_server.feed_irc('318', me, me, 'End of /WHOIS list.')
+
+    eevee = yield from whois_eevee
+    fred = yield from whois_fred
+    myself = yield from whois_me
+
+    assert [m.args[1] for m in eevee] == ['eevee', 'eevee']
+    assert [m.args[1] for m in fred] == ['fred', 'fred']
+    assert [m.args[1] for m in myself] == [me, me]
+    assert not client._message_waiters
+    assert not client._target_waiters
+
+
+@asyncio.coroutine
+def test_gather_messages_timeout(loop, client, fake_server):
+    try:
+        yield from client.gather_messages(
+            'BEGIN', finish=['END'], target='#bot', timeout=0.01)
+    except asyncio.TimeoutError:
+        pass
+    else:
+        assert False, "gather_messages didn't time out"
+
+    assert not client._message_waiters
+    assert not client._target_waiters
+
+
+@asyncio.coroutine
+def test_labeled_response(loop, client, fake_server):
+    fake_server.reader.feed_data(
+        b":irc.example.com CAP * LS :batch labeled-response sasl\r\n"
+        b":irc.example.com CAP * ACK :batch labeled-response\r\n")
+    yield from asyncio.sleep(0, loop=loop)
+    assert client.capabilities == {'batch', 'labeled-response'}
+    sent = client._writer.transport.buf.getvalue()
+    assert b"CAP LS 302\r\n" in sent
+    assert b"CAP REQ :batch labeled-response\r\n" in sent
+    assert b"CAP END\r\n" in sent
+
+    whois = asyncio.async(client.whois('eevee'), loop=loop)
+    yield from asyncio.sleep(0, loop=loop)
+    assert client._writer.transport.buf.getvalue().endswith(
+        b"@label=0 WHOIS eevee\r\n")
+
+    # Only the lines in the labeled batch belong to us, even though the
+    # untagged one looks like a perfectly good reply
+    fake_server.reader.feed_data(
+        b"@label=0 :irc.example.com BATCH +abc labeled-response\r\n"
+        b"@batch=abc :irc.example.com 311 dywypi eevee eevee b.d.f.l * :Eevee\r\n"
+        b":irc.example.com 311 dywypi eevee impostor evil.host * :Not Eevee\r\n"
+        b"@batch=abc :irc.example.com 318 dywypi eevee :End of /WHOIS list.\r\n"
+        b":irc.example.com BATCH -abc\r\n")
+    messages = yield from whois
+    assert [m.command for m in messages] == ['RPL_WHOISUSER', 'RPL_ENDOFWHOIS']
+    assert messages[0].args[2] == 'eevee'
+    assert not client._label_waiters
+    assert not client._label_batches
+
+
+@asyncio.coroutine
+def test_cap_negotiation(loop, client, fake_server):
+    fake_server.reader.feed_data(
+        b":irc.example.com CAP * LS * :multi-prefix sasl=PLAIN,EXTERNAL\r\n"
+        b":irc.example.com CAP * LS :server-time away-notify\r\n")
+    yield from asyncio.sleep(0, loop=loop)
+    assert client.available_capabilities['sasl'] == 'PLAIN,EXTERNAL'
+    sent = client._writer.transport.buf.getvalue()
+    # Only one REQ, once the whole list is in, and no END until it's answered
+    assert sent.count(b"CAP REQ") == 1
+    assert sent.endswith(b"CAP REQ :away-notify multi-prefix server-time\r\n")
+
+    fake_server.reader.feed_data(
+        b":irc.example.com CAP * ACK :away-notify multi-prefix server-time\r\n"
+        b":irc.example.com CAP dywypi NEW :extended-join\r\n"
+        b":irc.example.com CAP dywypi DEL :away-notify\r\n")
+    yield from asyncio.sleep(0, loop=loop)
+    assert client.capabilities == {'multi-prefix', 'server-time'}
+    sent = client._writer.transport.buf.getvalue()
+    assert sent.endswith(b"CAP END\r\nCAP REQ extended-join\r\n")
+
+    # Once registered, ACKs shouldn't send another END
+    fake_server.reader.feed_data(
+        b":irc.example.com CAP dywypi ACK :extended-join\r\n")
+    yield from asyncio.sleep(0, loop=loop)
+    assert 'extended-join' in client.capabilities
+    assert client._writer.transport.buf.getvalue().count(b"CAP END") == 1
+
+
+def test_message_tags():
+    from dywypi.dialect.irc.message import IRCMessage
+
+    line = r"@time=2014-07-04T08:00:00.000Z;msgid=abc;+example.com/x=a\sb\:c\\d\;novalue :nick!u@h PRIVMSG #bot :hi"
+    message = IRCMessage.parse(line)
+    assert message.args == ('#bot', 'hi')
+    # Nothing's been split up yet
+    assert message.tags._raw_values is None
+
+    assert message.tags['+example.com/x'] == 'a b;c\\d'
+    assert message.tags['novalue'] == ''
+    assert 'msgid' in message.tags
+    assert message.time.year == 2014
+    assert IRCMessage.parse_bytes(line.encode('utf8')).tags['msgid'] == 'abc'
+
+    # Untagged messages all share one empty set of tags
+    assert not IRCMessage.parse('PING :foo').tags
+
+    outgoing = IRCMessage(
+        'TAGMSG', '#bot', tags={'+example.com/x': 'a b;c\\d', 'label': 'xyz'})
+    rendered = outgoing.render()
+    assert rendered.startswith('@')
+    assert set(rendered[1:].split(' ')[0].split(';')) == {
+        r'+example.com/x=a\sb\:c\\d', 'label=xyz'}
+    assert IRCMessage.parse(rendered).tags['+example.com/x'] == 'a b;c\\d'
+
+
+@asyncio.coroutine
+def test_client_only_tags(loop, client, fake_server):
+    client.send_message('PRIVMSG', '#bot', 'hi', tags={'+draft/reply': 'abc'})
+    assert client._writer.transport.buf.getvalue().endswith(
+        b"PRIVMSG #bot hi\r\n")
+
+    client.capabilities.add('message-tags')
+    client.send_message('PRIVMSG', '#bot', 'hi', tags={'+draft/reply': 'abc'})
+    assert client._writer.transport.buf.getvalue().endswith(
+        b"@+draft/reply=abc PRIVMSG #bot hi\r\n")
+
+
+@asyncio.coroutine
+def test_flood_control(loop):
+    from dywypi.dialect.irc.flood import FloodControl
+    from dywypi.dialect.irc.flood import PRIORITY_CHATTER
+    from dywypi.dialect.irc.flood import PRIORITY_COMMAND
+    from dywypi.dialect.irc.flood import PRIORITY_PROTOCOL
+
+    written = []
+    flood = FloodControl(loop, written.append, burst=2, rate=100)
+    for n in range(4):
+        flood.send('chatter {}'.format(n), PRIORITY_CHATTER)
+    flood.send('command', PRIORITY_COMMAND)
+    flood.send('pong', PRIORITY_PROTOCOL)
+
+    # Burst went out immediately; PONG skipped the queue entirely
+    assert written == ['chatter 0', 'chatter 1', 'pong']
+    assert flood.depth == 3
+    assert flood.max_depth == 3
+
+    yield from asyncio.sleep(0.1, loop=loop)
+    # The command jumped ahead of the remaining chatter
+    assert written[3:] == ['command', 'chatter 2', 'chatter 3']
+    assert flood.depth == 0
+    assert flood.sent_count == 6
+    assert flood.max_wait > 0
+
+
+def test_flood_control_rejects_bad_limits(loop):
+    import pytest
+    from dywypi.dialect.irc.flood import FloodControl
+
+    with pytest.raises(ValueError):
+        FloodControl(loop, print, rate=0)
+    with pytest.raises(ValueError):
+        FloodControl(loop, print, burst=0)
+
+
+@asyncio.coroutine
+def test_flood_control_fairness(loop):
+    from dywypi.dialect.irc.flood import FloodControl
+    from dywypi.dialect.irc.flood import OVERFLOW_COLLAPSE
+    from dywypi.dialect.irc.flood import PRIORITY_CHATTER
+
+    written = []
+    flood = FloodControl(
+        loop, written.append, burst=1, rate=100,
+        max_target_depth=3, overflow=OVERFLOW_COLLAPSE,
+        collapse=lambda target, count: '{} lost {}'.format(target, count))
+    for n in range(6):
+        flood.send('a{}'.format(n), PRIORITY_CHATTER, '#a')
+    flood.send('b0', PRIORITY_CHATTER, '#b')
+    flood.send('b1', PRIORITY_CHATTER, '#b')
+
+    while flood.depth:
+        yield from asyncio.sleep(0.02, loop=loop)
+
+    # #a flooded, but #b still got a turn after every #a line, and #a's
+    # overflow was summarized at the end
+    assert written == ['a0', 'a1', 'b0', 'a2', 'b1', 'a3', '#a lost 2']
+    assert flood.dropped_count == 2
+
+
+def test_split_text():
+    from dywypi.dialect.irc.client import split_text
+
+    # Words stay whole, and the spaces between lines go away
+    assert split_text('aaa bbb ccc', 7) == ['aaa bbb', 'ccc']
+    assert split_text('short', 100) == ['short']
+
+    # Multibyte characters are never cut in half
+    lines = split_text('é' * 10, 5)
+    assert lines == ['éé', 'éé', 'éé', 'éé', 'éé']
+
+    # Formatting still on at the end of a line carries over to the next, and
+    # color codes aren't separated from their numbers
+    lines = split_text('\x02\x034,12bold blue\x03 \x1fplain', 12)
+    assert lines == ['\x02\x034,12bold', '\x02\x0304,12blue\x03', '\x02\x1fplain']
+    for line in lines:
+        assert len(line.encode('utf8')) <= 12
+
+
+@asyncio.coroutine
+def test_say_splits_long_messages(loop, client, fake_server):
+    fake_server.reader.feed_data(
+        b':irc.example.com 001 dywypi :Welcome, dywypi!~dywypi@example.com\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+    assert client.userhost == '~dywypi@example.com'
+
+    client._writer.transport.buf.seek(0)
+    client._writer.transport.buf.truncate()
+    words = ['word{}'.format(n) for n in range(100)]
+    yield from client.say('#bot', ' '.join(words))
+
+    relayed = []
+    for line in client._writer.transport.buf.getvalue().splitlines():
+        assert line.startswith(b'PRIVMSG #bot :')
+        # What everyone else sees has our prefix on it
+        relayed.append(b':dywypi!~dywypi@example.com ' + line)
+    assert len(relayed) > 1
+    assert all(len(line) <= client.len_message for line in relayed)
+    assert b' '.join(line.split(b' :', 1)[1] for line in relayed) == (
+        ' '.join(words).encode('utf8'))
+
+
+@asyncio.coroutine
+def test_broadcast(loop, client, fake_server):
+    fake_server.reader.feed_data(
+        b':irc.example.com 005 dywypi MAXTARGETS=1 TARGMAX=PRIVMSG:3,NOTICE: '
+        b':are supported by this server\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+    assert client.command_max_targets == {'PRIVMSG': 3, 'NOTICE': None}
+
+    client._writer.transport.buf.seek(0)
+    client._writer.transport.buf.truncate()
+    channels = ['#a', '#b', '#B', '#c', '#d', '#e', '#f']
+    yield from client.broadcast(channels, 'hello')
+    assert client._writer.transport.buf.getvalue() == (
+        b'PRIVMSG #a,#b,#c hello\r\n'
+        b'PRIVMSG #d,#e,#f hello\r\n')
+
+
+@asyncio.coroutine
+def test_join_many(loop, client, fake_server):
+    fake_server.reader.feed_data(
+        b':irc.example.com 005 dywypi CHANLIMIT=#:3 TARGMAX=JOIN:2 '
+        b':are supported by this server\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+    client._writer.transport.buf.seek(0)
+    client._writer.transport.buf.truncate()
+
+    future = asyncio.async(client.join_many(
+        ['#a', ('#b', 'sekrit'), '#c', '#d']), loop=loop)
+    yield from asyncio.sleep(0, loop=loop)
+
+    # Keyed channels go first; #d is past the channel limit
+    assert client._writer.transport.buf.getvalue() == (
+        b'JOIN #b,#a sekrit\r\n'
+        b'JOIN #c\r\n')
+
+    nick = client.nick.encode('utf8')
+    for channel in (b'#a', b'#b'):
+        fake_server.reader.feed_data(
+            b':' + nick + b'!~dywypi@example.com JOIN ' + channel + b'\r\n'
+            b':irc.example.com 353 dywypi = ' + channel + b' :dywypi\r\n'
+            b':irc.example.com 366 dywypi ' + channel +
+            b' :End of /NAMES list.\r\n')
+    fake_server.reader.feed_data(
+        b':irc.example.com 474 dywypi #c :Cannot join channel (+b)\r\n')
+
+    results = yield from future
+    assert list(results) == ['#a', '#b', '#c', '#d']
+    assert results['#a'].name == '#a'
+    assert results['#b'].sync
+    assert results['#c'].message.command == 'ERR_BANNEDFROMCHAN'
+    assert results['#d'].message.command == 'ERR_TOOMANYCHANNELS'
+
+
+@asyncio.coroutine
+def test_reconnect(loop, client, fake_server):
+    from dywypi.dialect.irc.client import STATE_CONNECTED
+    from dywypi.event import Connected, Disconnected
+
+    client.reconnect_delay = 0.01
+    nick = client.nick.encode('utf8')
+    fake_server.reader.feed_data(
+        b':irc.example.com 001 ' + nick + b' :Welcome\r\n'
+        b':' + nick + b'!~dywypi@example.com JOIN #a\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+    assert client.state == STATE_CONNECTED
+    assert '#a' in client.joined_channels
+
+    old_reader = fake_server.reader
+    old_reader.feed_eof()
+    for _ in range(10):
+        yield from asyncio.sleep(0, loop=loop)
+
+    # Reconnected right away, since the connection had been fine
+    assert fake_server.reader is not old_reader
+    assert not client.joined_channels
+    assert client._writer.transport.buf.getvalue().startswith(b'CAP LS 302')
+
+    fake_server.reader.feed_data(b':irc.example.com 001 ' + nick + b' :Welcome\r\n')
+    for _ in range(3):
+        yield from asyncio.sleep(0, loop=loop)
+    assert client._writer.transport.buf.getvalue().endswith(b'JOIN #a\r\n')
+
+    events = []
+    while not client.read_queue.empty():
+        events.append(type(client.read_queue.get_nowait()))
+    assert events == [Connected, Disconnected, Connected]
+
+
+@asyncio.coroutine
+def test_rejoin_with_key(loop, client, fake_server):
+    client.reconnect_delay = 0.01
+    nick = client.nick.encode('utf8')
+    fake_server.reader.feed_data(b':irc.example.com 001 ' + nick + b' :Welcome\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+
+    join = asyncio.async(client.join('#secret', 'hunter2'), loop=loop)
+    yield from asyncio.sleep(0, loop=loop)
+    fake_server.reader.feed_data(
+        b':' + nick + b'!u@h JOIN #secret\r\n'
+        b':irc 366 ' + nick + b' #secret :End of /NAMES list.\r\n'
+        b':' + nick + b'!u@h JOIN #other\r\n'
+        b':op!o@h MODE #other +k swordfish\r\n')
+    channel = yield from join
+    assert channel.key == 'hunter2'
+    assert client.joined_channels['#other'].key == 'swordfish'
+
+    fake_server.reader.feed_eof()
+    for _ in range(10):
+        yield from asyncio.sleep(0, loop=loop)
+    fake_server.reader.feed_data(b':irc.example.com 001 ' + nick + b' :Welcome\r\n')
+    for _ in range(3):
+        yield from asyncio.sleep(0, loop=loop)
+    assert client._writer.transport.buf.getvalue().endswith(
+        b'JOIN #secret,#other hunter2,swordfish\r\n')
+
+
+@asyncio.coroutine
+def test_rejoin_keyed_autojoin(loop, client, fake_server):
+    client.reconnect_delay = 0.01
+    nick = client.nick.encode('utf8')
+    fake_server.reader.feed_data(b':irc.example.com 001 ' + nick + b' :Welcome\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+
+    join = asyncio.async(client.join('#secret', 'hunter2'), loop=loop)
+    yield from asyncio.sleep(0, loop=loop)
+    fake_server.reader.feed_data(
+        b':' + nick + b'!u@h JOIN #secret\r\n'
+        b':irc 366 ' + nick + b' #secret :End of /NAMES list.\r\n')
+    yield from join
+
+    # Also an autojoin, without the key, and cased differently
+    client.network.autojoins = ['#SECRET']
+    fake_server.reader.feed_eof()
+    for _ in range(10):
+        yield from asyncio.sleep(0, loop=loop)
+    fake_server.reader.feed_data(b':irc.example.com 001 ' + nick + b' :Welcome\r\n')
+    for _ in range(3):
+        yield from asyncio.sleep(0, loop=loop)
+    assert client._writer.transport.buf.getvalue().endswith(
+        b'JOIN #secret hunter2\r\n')
+
+
+@asyncio.coroutine
+def test_reconnect_forgets_isupport(loop, client, fake_server):
+    client.reconnect_delay = 0.01
+    client.flood_weights = {'#Chan[1]': 3}
+    nick = client.nick.encode('utf8')
+    fake_server.reader.feed_data(
+        b':irc.example.com 001 ' + nick + b' :Welcome\r\n'
+        b':irc 005 ' + nick + b' CASEMAPPING=ascii PREFIX=(qov)~@+ '
+        b'CHANMODES=b,k,l,imnpst TARGMAX=JOIN:5 NICKLEN=30 :are supported\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+    assert client.casemapping.name == 'ascii'
+    assert client.len_nick == 30
+
+    # The next server in the rotation might be configured differently
+    fake_server.reader.feed_eof()
+    for _ in range(10):
+        yield from asyncio.sleep(0, loop=loop)
+    assert client.casemapping.name == 'rfc1459'
+    assert client.len_nick == 9
+    assert client.command_max_targets == {}
+    assert [mode.letter for mode in client.prefix_modes] == ['o', 'v']
+    assert 'q' not in client.channel_modes
+    assert client.send_queue._lanes[0].weights == {'#chan{1}': 3}
+
+    # Flood weights follow a CASEMAPPING that arrives after connecting
+    fake_server.reader.feed_data(
+        b':irc 005 ' + nick + b' CASEMAPPING=ascii :are supported\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+    assert client.send_queue._lanes[0].weights == {'#chan[1]': 3}
+
+
+@asyncio.coroutine
+def test_reconnect_after_socket_error(loop, client, fake_server):
+    client.reconnect_delay = 0.01
+    nick = client.nick.encode('utf8')
+    fake_server.reader.feed_data(b':irc.example.com 001 ' + nick + b' :Welcome\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+
+    # Not a ConnectionError, and the reader never sees EOF after it
+    old_reader = fake_server.reader
+    old_reader.set_exception(TimeoutError("Connection timed out"))
+    for _ in range(10):
+        yield from asyncio.sleep(0, loop=loop)
+
+    assert fake_server.reader is not old_reader
+    assert client._writer.transport.buf.getvalue().startswith(b'CAP LS 302')
+
+
+@asyncio.coroutine
+def test_connect_race(loop, fake_server):
+    from dywypi.dialect.irc.client import IRCClient
+    from dywypi.state import Network
+
+    class DeadServer:
+        host = 'dead.example.com'
+        port = 6667
+        password = None
+        cancelled = False
+
+        @asyncio.coroutine
+        def connect(self, loop):
+            try:
+                yield from asyncio.sleep(60, loop=loop)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+
+    dead = DeadServer()
+    network = Network('dywypi-test')
+    network.servers.extend([dead, fake_server])
+    client = IRCClient(loop, network)
+    client.connect_race = 2
+    client.connect_race_stagger = 0.01
+
+    # The first server never answers, but the second one gets a go anyway
+    yield from client.connect()
+    assert client.current_server is fake_server
+    yield from asyncio.sleep(0.01, loop=loop)
+    assert dead.cancelled
+
+
+@asyncio.coroutine
+def test_write_stall(loop, client, fake_server):
+    client.write_stall_timeout = 0.01
+    transport = client._writer.transport
+
+    # Backed up, but it clears before the deadline
+    transport.buffered = client.write_buffer_high + 1
+    client.send_message('PING', 'x')
+    assert client.write_buffer_size == transport.buffered
+    transport.buffered = 0
+    yield from asyncio.sleep(0.02, loop=loop)
+    assert not transport.aborted
+
+    # Backed up and stays that way
+    transport.buffered = client.write_buffer_high + 1
+    client.send_message('PING', 'x')
+    yield from asyncio.sleep(0.02, loop=loop)
+    assert transport.aborted
+
+
+@asyncio.coroutine
+def test_lag_monitor(loop, client, fake_server):
+    fake_server.reader.feed_data(b':irc.example.com 001 dywypi :Welcome\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+    monitor = client.lag_monitor
+    monitor.timeout = 0.05
+
+    client._writer.transport.buf.seek(0)
+    client._writer.transport.buf.truncate()
+    monitor.start()
+    token = client._writer.transport.buf.getvalue().split()[-1]
+    fake_server.reader.feed_data(
+        b':irc.example.com PONG irc.example.com :' + token + b'\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+    assert len(monitor.samples) == 1
+    assert monitor.lag == monitor.samples[0] == monitor.percentile(99)
+    assert sum(count for bound, count in monitor.histogram()) == 1
+
+    # Unrelated PONGs are ignored
+    assert not monitor.pong('something else')
+
+    # No answer at all means the connection is dead
+    monitor.start()
+    yield from asyncio.sleep(0.1, loop=loop)
+    assert client._writer.transport.aborted
+
+
+@asyncio.coroutine
+def test_event_subscriptions(loop, client, fake_server):
+    class CommandsOnly:
+        wants_commands = True
+
+        def wants(self, event_cls):
+            return False
+
+    client.event_subscriptions = CommandsOnly()
+    nick = client.nick.encode('utf8')
+    fake_server.reader.feed_data(
+        b':someone!u@h PRIVMSG #bot :just chatting\r\n'
+        b':someone!u@h PRIVMSG #bot :' + nick + b': help\r\n'
+        b':someone!u@h PRIVMSG ' + nick + b' :help\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+
+    # Only the lines addressed to us became events
+    events = []
+    while not client.read_queue.empty():
+        events.append(client.read_queue.get_nowait())
+    assert [event.message for event in events] == [
+        client.nick + ': help', 'help']
+
+    # With no interest in commands either, the text is never even decoded
+    class Nothing:
+        wants_commands = False
+
+        def wants(self, event_cls):
+            return False
+
+    client.event_subscriptions = Nothing()
+    seen = []
+    old_handler = client.add_handler(
+        'PRIVMSG',
+        lambda client, message: seen.append(message) or
+            old_handler(client, message))
+    fake_server.reader.feed_data(b':someone!u@h PRIVMSG #bot :chatter\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+    assert len(seen) == 1
+    assert seen[0]._raw_trailing is not None
+    assert client.read_queue.empty()
+
+
+@asyncio.coroutine
+def test_user_registry(loop, client, fake_server):
+    nick = client.nick.encode('utf8')
+    for channel in (b'#one', b'#two'):
+        fake_server.reader.feed_data(
+            b':' + nick + b'!u@h JOIN ' + channel + b'\r\n'
+            b':irc 353 ' + nick + b' = ' + channel + b' :@Fred ' + nick + b'\r\n'
+            b':irc 366 ' + nick + b' ' + channel + b' :End of /NAMES list.\r\n')
+    fake_server.reader.feed_data(
+        b':fred!fred@example.com PRIVMSG #one :hello\r\n'
+        b':stranger!s@h PRIVMSG #one :hi\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+
+    # One shared record, no matter how many channels or lines
+    fred = client.users.get('FRED')
+    assert fred is client.joined_channels['#one'].users['Fred']
+    assert fred is client.joined_channels['#two'].users['Fred']
+    assert (fred.name, fred.ident, fred.host) == (
+        'fred', 'fred', 'example.com')
+    assert 'stranger' not in client.users
+    assert len(client.users) == 2
+
+    # Records go away once the user shares no channels with us
+    client.users.remove('#one', 'fred')
+    assert client.users.channels_of('fred') == {'#two'}
+    assert client.users.remove('#two', 'fred') is fred
+    assert 'fred' not in client.users
+
+
+@asyncio.coroutine
+def test_channel_state(loop, client, fake_server):
+    nick = client.nick.encode('utf8')
+    for channel in (b'#one', b'#two'):
+        fake_server.reader.feed_data(
+            b':' + nick + b'!u@h JOIN ' + channel + b'\r\n'
+            b':irc 353 ' + nick + b' = ' + channel +
+            b' :@fred wilma +@' + nick + b'\r\n'
+            b':irc 366 ' + nick + b' ' + channel + b' :End of /NAMES list.\r\n')
+    fake_server.reader.feed_data(
+        b':barney!b@h JOIN #one\r\n'
+        b':fred!f@h MODE #one +ol-o barney 10 fred\r\n'
+        b':fred!f@h TOPIC #one :yabba dabba doo\r\n'
+        b':fred!f@h NICK freddy\r\n'
+        b':wilma!w@h PART #one :bye\r\n'
+        b':freddy!f@h KICK #two wilma :out\r\n'
+        b':barney!b@h QUIT :gone\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+
+    one = client.joined_channels['#one']
+    two = client.joined_channels['#two']
+    assert set(one.users) == {'freddy', client.nick}
+    assert set(two.users) == {'freddy', client.nick}
+    assert one.highest_prefix('freddy') is None
+    assert 'freddy' not in one.user_modes
+    assert two.highest_prefix('FREDDY') == '@'
+    assert two.has_mode('freddy', 'o')
+    assert not two.has_mode('freddy', 'v')
+    assert one.modes == {'l': '10'}
+    assert one.topic.text == 'yabba dabba doo'
+    assert one.topic.author is client.users.get('freddy')
+    assert 'wilma' not in client.users
+    assert 'barney' not in client.users
+    # multi-prefix gives every mode, in any order
+    assert one.highest_prefix(client.nick) == '@'
+    assert one.has_mode(client.nick, 'v')
+
+    # Leaving a channel forgets anyone we no longer share a channel with
+    fake_server.reader.feed_data(b':' + nick + b'!u@h PART #one\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+    assert '#one' not in client.joined_channels
+    assert client.users.channels_of('freddy') == {'#two'}
+
+
+@asyncio.coroutine
+def test_casemapping(loop, client, fake_server):
+    nick = client.nick.encode('utf8')
+    fake_server.reader.feed_data(
+        b':irc 005 ' + nick + b' CASEMAPPING=rfc1459 :are supported\r\n'
+        b':' + nick + b'!u@h JOIN #Foo[1]\r\n'
+        b':irc 353 ' + nick + b' = #foo{1} :Fred^ ' + nick + b'\r\n'
+        b':irc 366 ' + nick + b' #FOO{1} :End of /NAMES list.\r\n'
+        b':FRED~!f@h PART #foo[1]\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+
+    # Names match however they're cased, but keep the casing they came with
+    channel = client.joined_channels['#FOO{1}']
+    assert list(client.joined_channels) == ['#Foo[1]']
+    assert channel.sync
+    assert list(channel.users) == [client.nick]
+    assert 'fred^' not in client.users
+
+    fake_server.reader.feed_data(
+        b':irc 005 ' + nick + b' CASEMAPPING=ascii :are supported\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+    assert client._fold_name('Fred[]') == 'fred[]'
+
+
+def test_parse_mode_changes():
+    from dywypi.dialect.irc.state import IRCMode, parse_mode_changes
+    modes = {
+        'o': IRCMode('o', prefix='@', bit=1,
+            arg_on_set=True, arg_on_remove=True),
+        'v': IRCMode('v', prefix='+', bit=2,
+            arg_on_set=True, arg_on_remove=True),
+        'b': IRCMode('b', multi=True),
+        'k': IRCMode('k', arg_on_set=True, arg_on_remove=True),
+        'l': IRCMode('l', arg_on_set=True),
+        'm': IRCMode('m'),
+    }
+
+    changes = parse_mode_changes(
+        modes, '+ob-lk+Zm-v',
+        ['eevee', '*!*@spam', 'hunter2', 'dywypi'])
+    assert [(c.letter, c.adding, c.arg) for c in changes] == [
+        ('o', True, 'eevee'),
+        ('b', True, '*!*@spam'),
+        ('l', False, None),
+        ('k', False, 'hunter2'),
+        ('Z', True, None),
+        ('m', True, None),
+        ('v', False, 'dywypi'),
+    ]
+
+
+@asyncio.coroutine
+def test_isupport_mode_redefinition(loop, client, fake_server):
+    # A CHANMODES that reuses a prefix letter, a CHANMODES that doesn't,
+    # then another PREFIX
+    nick = client.nick.encode('utf8')
+    fake_server.reader.feed_data(
+        b':irc 005 ' + nick + b' CHANMODES=b,k,l,imnpstv :are supported\r\n'
+        b':irc 005 ' + nick + b' CHANMODES=b,k,l,imnpst :are supported\r\n'
+        b':irc 005 ' + nick + b' PREFIX=(qo)~@ :are supported\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+
+    assert [mode.letter for mode in client.prefix_modes] == ['q', 'o']
+    assert client.channel_modes['o'].prefix == '@'
+    assert client.channel_modes['q'].prefix == '~'
+
+
+@asyncio.coroutine
+def test_mode_changes(loop, client, fake_server):
+    from dywypi.event import ModeChange
+    nick = client.nick.encode('utf8')
+    masks = [('*!*@spam{}.example'.format(i)).encode('ascii')
+        for i in range(200)]
+    fake_server.reader.feed_data(
+        b':irc 005 ' + nick + b' CHANMODES=beI,k,l,imnpst :are supported\r\n'
+        b':' + nick + b'!u@h JOIN #bot\r\n'
+        b':irc 366 ' + nick + b' #bot :End of /NAMES list.\r\n'
+        b':irc 367 ' + nick + b' #bot *!*@old ChanServ 1400000000\r\n'
+        b':ChanServ!s@services MODE #bot +' + b'b' * len(masks) + b' ' +
+        b' '.join(masks) + b'\r\n'
+        b':ChanServ!s@services MODE #bot -b+kl-k+e ' + masks[0] +
+        b' secret 10 secret *!*@friend\r\n')
+    yield from asyncio.sleep(0, loop=loop)
+
+    channel = client.joined_channels['#bot']
+    assert len(channel.lists['b']) == 200
+    assert '*!*@old' in channel.lists['b']
+    assert masks[0].decode('ascii') not in channel.lists['b']
+    assert channel.lists['e'] == {'*!*@friend'}
+    assert channel.modes == {'l': '10'}
+
+    events = []
+    while not client.read_queue.empty():
+        event = client.read_queue.get_nowait()
+        if isinstance(event, ModeChange):
+            events.append(event)
+    assert len(events) == 2
+    assert events[0].channel is channel
+    assert events[0].source.name == 'ChanServ'
+    assert len(events[0].changes) == 200
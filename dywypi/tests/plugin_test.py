@@ -7,3 +7,31 @@ def test_scan_package():
     manager.scan_package('dywypi.plugins')
     assert 'echo' in manager.known_plugins
     manager.scan_package('dywypi.plugins')
+
+
+def test_wants():
+    from dywypi.event import Connected
+    from dywypi.event import Message, PrivateMessage, PublicMessage
+    from dywypi.plugin import Plugin
+
+    manager = PluginManager()
+    manager.scan_package('dywypi.plugins')
+    assert not manager.wants(Message)
+    assert not manager.wants_commands
+
+    # echo listens on Message, and has a command
+    manager.load('echo')
+    assert manager.wants(Message)
+    assert not manager.wants(Connected)
+    assert manager.wants_commands
+
+    # Listening on one kind of message says nothing about its siblings
+    plugin = Plugin('test-wants-private')
+
+    @plugin.on(PrivateMessage)
+    def private(event):
+        pass
+
+    manager.load('test-wants-private')
+    assert manager.wants(PrivateMessage)
+    assert not manager.wants(PublicMessage)
@@ -0,0 +1,49 @@
+import asyncio
+
+from dywypi.queue import EventQueue
+from dywypi.queue import OVERFLOW_BLOCK
+from dywypi.queue import OVERFLOW_DROP_NEWEST
+from dywypi.queue import OVERFLOW_DROP_OLDEST
+
+
+def is_chatter(event):
+    return event.startswith('chat')
+
+
+def test_drop_oldest(loop):
+    queue = EventQueue(
+        loop, maxsize=2, overflow=OVERFLOW_DROP_OLDEST, droppable=is_chatter)
+    for event in ('chat1', 'connected', 'chat2', 'chat3', 'disconnected'):
+        queue.put_nowait(event)
+
+    # Chatter makes way for everything else
+    assert list(queue._items) == ['connected', 'disconnected']
+    assert queue.dropped_count == 3
+
+    # And protected events get in even when there's no chatter left to drop
+    queue.put_nowait('quit')
+    assert list(queue._items) == ['connected', 'disconnected', 'quit']
+
+
+def test_drop_newest(loop):
+    queue = EventQueue(
+        loop, maxsize=2, overflow=OVERFLOW_DROP_NEWEST, droppable=is_chatter)
+    for event in ('chat1', 'chat2', 'chat3', 'connected'):
+        queue.put_nowait(event)
+
+    assert list(queue._items) == ['chat1', 'chat2', 'connected']
+    assert queue.dropped_count == 1
+
+
+@asyncio.coroutine
+def test_block(loop):
+    queue = EventQueue(loop, maxsize=1, overflow=OVERFLOW_BLOCK)
+    yield from queue.put('chat1')
+    putter = asyncio.async(queue.put('chat2'), loop=loop)
+    yield from asyncio.sleep(0, loop=loop)
+    assert not putter.done()
+
+    assert (yield from queue.get()) == 'chat1'
+    yield from putter
+    assert (yield from queue.get()) == 'chat2'
+    assert queue.dropped_count == 0
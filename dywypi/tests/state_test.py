@@ -0,0 +1,66 @@
+import ssl
+
+from dywypi.state import Network
+from dywypi.state import ResumingSSLContext
+
+
+class DummyWriter:
+    def __init__(self, session):
+        self.session = session
+
+    def get_extra_info(self, name):
+        assert name == 'ssl_object'
+        return self
+
+
+def test_network_shares_ssl_context():
+    network = Network('dywypi-test')
+    network.add_server('irc1.example.com', tls=True)
+    network.add_server('irc2.example.com', tls=True)
+    network.add_server('irc3.example.com')
+
+    tls1, tls2, plain = network.servers
+    assert isinstance(tls1.ssl_context, ResumingSSLContext)
+    assert tls1.ssl_context is tls2.ssl_context is network.ssl_context
+    assert plain.ssl_context is False
+
+    # Changing the settings builds a fresh context, used by every server
+    old_context = network.ssl_context
+    network.configure_tls(verify=False)
+    assert network.ssl_context is not old_context
+    assert tls1.ssl_context is tls2.ssl_context is network.ssl_context
+    assert network.ssl_context.verify_mode == ssl.CERT_NONE
+
+
+def test_ssl_session_resumption(monkeypatch):
+    network = Network('dywypi-test')
+    network.add_server('irc1.example.com', tls=True)
+    network.add_server('irc2.example.com', tls=True)
+    server1, server2 = network.servers
+    context = network.ssl_context
+
+    offered = []
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+            server_hostname=None, session=None):
+        offered.append((server_hostname, session))
+
+    monkeypatch.setattr(ssl.SSLContext, 'wrap_bio', wrap_bio)
+
+    session = object()
+    server1.save_tls_session(DummyWriter(session))
+    assert context.sessions == {'irc1.example.com': session}
+
+    # Only a connection to the same host gets the saved session
+    incoming = ssl.MemoryBIO()
+    outgoing = ssl.MemoryBIO()
+    context.wrap_bio(incoming, outgoing, server_hostname='irc1.example.com')
+    context.wrap_bio(incoming, outgoing, server_hostname='irc2.example.com')
+    assert offered == [
+        ('irc1.example.com', session),
+        ('irc2.example.com', None),
+    ]
+
+    # No session yet, e.g. before the server has sent one, means no change
+    server2.save_tls_session(DummyWriter(None))
+    assert 'irc2.example.com' not in context.sessions